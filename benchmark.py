@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# benchmark.py - Time the solver, solution counting, difficulty rating
+# and puzzle generation over the puzzles/ corpus.
+#
+#   benchmark.py run [options] [PUZZLE DIRECTORY]
+# writes JSON results (to standard output, or -o FILE);
+#   benchmark.py compare [options] OLD.json NEW.json
+# reports the change for each size and case, and exits 1 if any got
+# slower (or visited more nodes) by more than the threshold.
+
+import sys, os, time, json, optparse, platform, multiprocessing, resource
+
+from sudoku import *
+
+BENCH_SOLVE      = 'solve'
+BENCH_COUNT      = 'count'
+BENCH_DIFFICULTY = 'difficulty'
+BENCH_GENERATE   = 'generate'
+
+BENCH_CASES = [BENCH_SOLVE, BENCH_COUNT, BENCH_DIFFICULTY, BENCH_GENERATE]
+
+def sizeName(size):
+    return '%dx%d' % tuple(size)
+
+def benchTask(task):
+    """Run one case on one puzzle (or one generation for a size) and
+    measure it. Runs in a fresh worker process, so that peak memory is
+    the task's own."""
+    (case, source, method, repeat) = task
+    setSolveMethod(method)
+
+    # A SearchMonitor passed as progress counts nodes across every search
+    # the task runs, without calling back.
+    monitor = [None]
+    stats = [None]
+
+    if case == BENCH_GENERATE:
+        (size, seed) = source
+        result = {'case': case, 'size': sizeName(size), 'seed': seed}
+        def run():
+            randomPuzzle(size, progress = monitor[0], seed = seed)
+    else:
+        board = readSudoku(source)
+        result = {'case': case, 'size': sizeName(board.regionSize),
+                  'file': source}
+        if case == BENCH_SOLVE:
+            def run():
+                board.solve(progress = monitor[0], stats = stats[0])
+        elif case == BENCH_COUNT:
+            def run():
+                board.solve(countOnly = True, maxCount = 2,
+                            progress = monitor[0], stats = stats[0])
+        elif case == BENCH_DIFFICULTY:
+            def run():
+                board.difficulty(progress = monitor[0],
+                                 cache = DifficultyCache(), stats = stats[0])
+        else:
+            raise ValueError('Unknown benchmark case: %s' % case)
+
+    startMemory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    best = None
+    for i in range(repeat):
+        monitor[0] = SearchMonitor()
+        stats[0] = SolveStats()
+        start = time.time()
+        run()
+        elapsed = time.time() - start
+        if (best == None) or (elapsed < best):
+            best = elapsed
+    peakMemory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    result['time'] = round(best, 6)
+    result['nodes'] = monitor[0].nodes
+    if case != BENCH_GENERATE:
+        result['stats'] = stats[0].asDict()
+    # ru_maxrss is in kilobytes on Linux.
+    result['peakKB'] = peakMemory
+    result['growthKB'] = peakMemory - startMemory
+    return result
+
+def benchTasks(directory, cases, sizes, method, repeat, seed):
+    tasks = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if not os.path.isdir(path) or (sizes and name not in sizes):
+            continue
+        files = findPuzzleFiles([path])
+        for case in cases:
+            if case == BENCH_GENERATE:
+                size = tuple([int(n) for n in name.split('x')])
+                tasks.append((case, (size, seed), method, repeat))
+            else:
+                for filename in files:
+                    tasks.append((case, filename, method, repeat))
+    return tasks
+
+def summarise(results):
+    "Total time and nodes, and the largest peak memory, per size and case."
+    totals = {}
+    for result in results:
+        key = '%s %s' % (result['size'], result['case'])
+        if key not in totals:
+            totals[key] = {'puzzles': 0, 'time': 0.0, 'nodes': 0, 'peakKB': 0}
+        total = totals[key]
+        total['puzzles'] += 1
+        total['time'] = round(total['time'] + result['time'], 6)
+        total['nodes'] += result['nodes']
+        total['peakKB'] = max(total['peakKB'], result['peakKB'])
+    return totals
+
+def runBenchmark(directory = 'puzzles', cases = BENCH_CASES, sizes = None,
+                 method = SOLVE_DLX, repeat = 1, seed = 1, workers = 1):
+    """Run the benchmark and return its results as a dict, ready to be
+    written as JSON. Each task gets a fresh process; more than one worker
+    is faster but makes the timings noisier."""
+    tasks = benchTasks(directory, cases, sizes, method, repeat, seed)
+    pool = multiprocessing.Pool(workers, maxtasksperchild = 1)
+    try:
+        results = pool.map(benchTask, tasks, 1)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'method': method, 'repeat': repeat, 'seed': seed,
+            'workers': workers,
+            'totals': summarise(results),
+            'results': results}
+
+def compareResults(old, new, threshold = 0.1, minTime = 0.05):
+    """Compare the totals of two benchmark runs. Returns a list of
+    (key, old total, new total, regressed) for the keys in both. A key
+    regresses if its node count or (for totals of at least minTime
+    seconds) its time grew by more than threshold, a fraction."""
+    rows = []
+    for key in sorted(new['totals']):
+        if key not in old['totals']:
+            continue
+        before = old['totals'][key]
+        after = new['totals'][key]
+        regressed = False
+        if max(before['time'], after['time']) >= minTime:
+            if after['time'] > before['time'] * (1 + threshold):
+                regressed = True
+        if after['nodes'] > before['nodes'] * (1 + threshold):
+            regressed = True
+        rows.append((key, before, after, regressed))
+    return rows
+
+def change(before, after):
+    if not before:
+        return '    n/a'
+    return '%+6.1f%%' % ((float(after) / before - 1) * 100)
+
+def runCommand(args):
+    parser = optparse.OptionParser(
+        usage = '%prog run [options] [PUZZLE DIRECTORY]')
+    parser.add_option('-o', '--output', default = '-',
+                      help = 'write results to this file (default: stdout)')
+    parser.add_option('-c', '--case', action = 'append', dest = 'cases',
+                      choices = BENCH_CASES,
+                      help = 'case to run, may be repeated (default: all)')
+    parser.add_option('-s', '--size', action = 'append', dest = 'sizes',
+                      help = 'size directory to run, e.g. 3x3 (default: all)')
+    parser.add_option('-m', '--method', default = SOLVE_DLX,
+                      choices = [SOLVE_BACKTRACK, SOLVE_DLX, SOLVE_PROPAGATE],
+                      help = 'solver to use (default: %default)')
+    parser.add_option('-r', '--repeat', type = 'int', default = 1,
+                      help = 'runs per task, keeping the fastest')
+    parser.add_option('--seed', type = 'int', default = 1,
+                      help = 'seed for the generate case (default: %default)')
+    parser.add_option('-j', '--workers', type = 'int', default = 1,
+                      help = 'worker processes (default: %default)')
+    (options, paths) = parser.parse_args(args)
+    if len(paths) > 1:
+        parser.error('give at most one puzzle directory')
+
+    if paths:
+        directory = paths[0]
+    else:
+        directory = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'puzzles')
+    results = runBenchmark(directory, options.cases or BENCH_CASES,
+                           options.sizes, options.method, options.repeat,
+                           options.seed, options.workers)
+
+    if options.output == '-':
+        out = sys.stdout
+    else:
+        out = file(options.output, 'w')
+    json.dump(results, out, sort_keys = True, indent = 1)
+    out.write('\n')
+    if out is not sys.stdout:
+        out.close()
+    return 0
+
+def compareCommand(args):
+    parser = optparse.OptionParser(
+        usage = '%prog compare [options] OLD.json NEW.json')
+    parser.add_option('-t', '--threshold', type = 'float', default = 0.1,
+                      help = 'allowed fractional slowdown (default: %default)')
+    parser.add_option('--min-time', type = 'float', default = 0.05,
+                      help = 'ignore time changes in totals shorter than '
+                             'this many seconds (default: %default)')
+    (options, paths) = parser.parse_args(args)
+    if len(paths) != 2:
+        parser.error('need two result files')
+
+    (old, new) = [json.load(file(path)) for path in paths]
+    rows = compareResults(old, new, options.threshold, options.min_time)
+    failed = 0
+    print '%-16s %10s %10s %8s %8s' % ('', 'old time', 'new time', 'time',
+                                       'nodes')
+    for (key, before, after, regressed) in rows:
+        print '%-16s %10.3f %10.3f %8s %8s%s' % (
+            key, before['time'], after['time'],
+            change(before['time'], after['time']),
+            change(before['nodes'], after['nodes']),
+            regressed and '  REGRESSION' or '')
+        if regressed:
+            failed += 1
+
+    return failed and 1 or 0
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['run']:
+        sys.exit(runCommand(sys.argv[2:]))
+    elif sys.argv[1:2] == ['compare']:
+        sys.exit(compareCommand(sys.argv[2:]))
+    else:
+        print >> sys.stderr, 'usage: %s run|compare [options] ...' % sys.argv[0]
+        sys.exit(2)
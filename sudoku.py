@@ -1,7 +1,10 @@
 # sudoku.py - Core Sudoku board representation, solving algorithm
 # and other such.
 
-import sys, re, math, random
+import sys, os, re, math, random, time, glob, json, optparse
+import multiprocessing, multiprocessing.util, collections
+import struct, mmap, binascii, marshal
+from array import array
 
 def testDifficulty():
     for filename in ['easy.txt', 'moderate.txt', 'medium.txt', 'challenging.txt', 'tough.txt', 'deadend.txt']:
@@ -11,6 +14,27 @@ CELL_PRESET = 0
 CELL_UNSET  = 1
 
 sizeLine = re.compile('^\\s*([0-9]+)\\s*,\\s*([0-9]+)\\s*$')
+seedLine = re.compile('^\\s*#\\s*seed\\s+(-?[0-9]+)\\s*$')
+cellToken = re.compile('(\\*[^.0-9]*)?([.0-9]+)')
+lineSize = re.compile('^\\s*([0-9]+)\\s*,\\s*([0-9]+)\\s*:')
+
+# Digits for the one-line format: values up to 35 take one character
+# each, '.' or '0' for an empty cell.
+LINE_DIGITS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+# Solver backends for SudokuBoard.solve.
+SOLVE_BACKTRACK = 'backtrack'
+SOLVE_DLX       = 'dlx'
+SOLVE_PROPAGATE = 'propagate'
+
+solveMethod = SOLVE_BACKTRACK
+
+def setSolveMethod(method):
+    "Set the solver used when SudokuBoard.solve isn't given a method."
+    global solveMethod
+    if method not in (SOLVE_BACKTRACK, SOLVE_DLX, SOLVE_PROPAGATE):
+        raise ValueError('Unknown solve method: %s' % method)
+    solveMethod = method
 
 DIFFICULTY_STR = (
     (5.0,  'Outrageous'),
@@ -20,186 +44,786 @@ DIFFICULTY_STR = (
     (None, 'Easy')
     )
 
+# Sets of values are held as bitmasks, with bit (value - 1) set for
+# each value in the set.
+
+def valueBit(value):
+    return 1 << (value - 1)
+
+def popCount(mask):
+    return bin(mask).count('1')
+
+def lowestValue(mask):
+    "Smallest value in mask, or None if it is empty."
+    return (mask & -mask).bit_length() or None
+
+def maskValues(mask):
+    values = []
+    while mask:
+        bit = mask & -mask
+        values.append(bit.bit_length())
+        mask ^= bit
+    return values
+
+def boardBytes(board):
+    """Approximate memory held by a SudokuBoard or BoardState, including
+    its cells and sets but not the BoardGeometry shared between boards."""
+    seen = {id(board.geometry): True}
+    for coord in board.geometry.coords:
+        seen[id(coord)] = True
+
+    total = 0
+    pending = [board]
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or obj is None or isinstance(obj, (bool, str)):
+            continue
+        if isinstance(obj, int) and -5 <= obj <= 256:
+            # Small ints are shared by the interpreter.
+            continue
+        seen[id(obj)] = True
+        total += sys.getsizeof(obj)
+
+        if isinstance(obj, (list, tuple)):
+            pending.extend(obj)
+        elif isinstance(obj, dict):
+            pending.extend(obj.values())
+        else:
+            if hasattr(obj, '__dict__'):
+                pending.append(obj.__dict__)
+            for name in getattr(type(obj), '__slots__', ()):
+                pending.append(getattr(obj, name, None))
+
+    return total
+
 def readSudoku(filename):
+    "Read the first puzzle in a file."
     infile = file(filename)
-    numbers = []
+    try:
+        for board in iterSudoku(infile):
+            return board
+    finally:
+        infile.close()
+    raise ValueError('No puzzle in %s' % filename)
+
+def iterSudoku(lines):
+    """Parse puzzles from an open file (or any iterable of lines) and yield
+    a SudokuBoard for each, one at a time. Puzzles may be concatenated: a
+    size line starts a new puzzle, and once a puzzle of known size has all
+    its cells the next one begins at the same size. A puzzle with no size
+    line is assumed to be square and runs to the end of the input."""
     size = None
-    for line in infile.readlines():
+    seed = None
+    values = []
+    presets = []
+    for line in lines:
         sizeMatch = sizeLine.match(line)
         if sizeMatch:
+            if values:
+                yield makeBoard(size, values, presets, seed)
+                values = []
+                presets = []
+                seed = None
             size = (int(sizeMatch.group(1)), int(sizeMatch.group(2)))
             continue
-        
-        preset = True
-        cur = ''
-        for char in line:
-            if char == '.' or char.isdigit():
-                cur += char
-            else:
-                if cur:
-                    cur = cur.replace('.', '')
-                    if cur.isdigit():
-                        numbers.append((int(cur), preset))
-                    else:
-                        numbers.append((None, False))
-                    cur = ''
-                    preset = True
-                if char == '*':
-                    preset = False
+        if line.lstrip().startswith('#'):
+            seedMatch = seedLine.match(line)
+            if seedMatch:
+                seed = int(seedMatch.group(1))
+            continue
 
+        # A number is preset unless marked with a '*' before it; a run of
+        # dots is an empty cell.
+        for (star, digits) in cellToken.findall(line):
+            digits = digits.replace('.', '')
+            if digits:
+                values.append(int(digits))
+                presets.append(not star)
+            else:
+                values.append(0)
+                presets.append(False)
+
+        if size:
+            cellCount = (size[0] * size[1]) ** 2
+            while len(values) >= cellCount:
+                yield makeBoard(size, values[:cellCount], presets[:cellCount], seed)
+                values = values[cellCount:]
+                presets = presets[cellCount:]
+                seed = None
+
+    if values:
+        yield makeBoard(size, values, presets, seed)
+
+def makeBoard(size, values, presets, seed = None):
+    "Build a board from parsed cell values (0 for empty) and preset flags."
     if not size:
-        width = int(math.sqrt(math.sqrt(len(numbers))))
+        width = int(math.sqrt(math.sqrt(len(values))))
         size = (width, width)
-    board = SudokuBoard((size[0], size[1]), (size[1], size[0]))
-    numbers.reverse()
-    for y in range(size[0] * size[1]):
-        for x in range(size[0] * size[1]):
-            (value, preset) = numbers.pop()
-            board[x, y] = value
-            if preset:
-                board[x, y].state = CELL_PRESET
-
+    geometry = getGeometry(size, (size[1], size[0]))
+    if len(values) != geometry.cellCount:
+        raise ValueError('Expected %d cells for a %dx%d puzzle, found %d'
+                         % (geometry.cellCount, size[0], size[1], len(values)))
+
+    bitmap = 0
+    for i in range(geometry.cellCount):
+        if presets[i]:
+            bitmap |= 1 << i
+    board = BoardState(geometry, array('B', values), bitmap).board()
+    board.seed = seed
     return board
 
 def writeSudoku(board, filename):
     out = file(filename, 'w')
     print >> out, '%d, %d' % board.regionSize
+    if board.seed != None:
+        print >> out, '# seed %d' % board.seed
     out.write(str(board))
     out.close()
 
-def randomCompleted(size = (3, 3), progress = None, cancel = None):
+def boardFromLine(line, regionSize = None):
+    """Parse a puzzle in the one-line format (see SudokuBoard.toLine).
+    The region size comes from a 'w,h:' prefix, then regionSize, and
+    otherwise the regions are assumed to be square. Every filled cell is
+    preset."""
+    sizeMatch = lineSize.match(line)
+    if sizeMatch:
+        regionSize = (int(sizeMatch.group(1)), int(sizeMatch.group(2)))
+        line = line[sizeMatch.end():]
+    line = line.strip()
+
+    if ',' in line:
+        tokens = [token.strip() for token in line.split(',')]
+    else:
+        tokens = list(line)
+
+    if not regionSize:
+        width = int(round(math.sqrt(math.sqrt(len(tokens)))))
+        regionSize = (width, width)
+    maxValue = regionSize[0] * regionSize[1]
+
+    values = []
+    for (position, token) in enumerate(tokens):
+        digits = token.strip('.')
+        if not digits:
+            value = 0
+        elif ',' not in line:
+            value = LINE_DIGITS.find(digits.upper())
+        elif digits.isdigit():
+            value = int(digits)
+        else:
+            value = -1
+        if value < 0 or value > maxValue:
+            raise ValueError('Bad cell %r at position %d for a %dx%d puzzle'
+                             % (token, position + 1,
+                                regionSize[0], regionSize[1]))
+        values.append(value)
+
+    return makeBoard(regionSize, values, [value != 0 for value in values])
+
+def iterLines(lines, regionSize = None):
+    "Yield a board for each puzzle line, skipping blank and '#' lines."
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield boardFromLine(line, regionSize)
+
+def readLines(filename, regionSize = None):
+    "iterLines over a file, or standard input if filename is '-'."
+    if filename == '-':
+        for board in iterLines(sys.stdin, regionSize):
+            yield board
+        return
+    infile = file(filename)
+    try:
+        for board in iterLines(infile, regionSize):
+            yield board
+    finally:
+        infile.close()
+
+def writeLines(boards, filename, presetOnly = False):
+    """Write boards one per line, to standard output if filename is '-'.
+    Returns the number written."""
+    if filename == '-':
+        out = sys.stdout
+    else:
+        out = file(filename, 'w')
+    count = 0
+    try:
+        for board in boards:
+            out.write(board.toLine(presetOnly) + '\n')
+            count += 1
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return count
+
+# Solver used to fill the random board randomPuzzle starts from. Each
+# solver shuffles differently, so this is fixed rather than following
+# setSolveMethod: the same seed must always make the same puzzle.
+GENERATE_METHOD = SOLVE_BACKTRACK
+
+def randomCompleted(size = (3, 3), progress = None, cancel = None, rng = None,
+                    method = GENERATE_METHOD):
     board = SudokuBoard((size[0], size[1]), (size[1], size[0]))
-    solution = board.solve(maxCount = 1, shuffle = True,
-                           progress = progress, cancel = cancel)
+    solution = board.solve(maxCount = 1, shuffle = True, progress = progress,
+                           cancel = cancel, method = method, rng = rng)
     return solution[0]
 
 def randomPuzzle(size = (3, 3), maxBranch = 0,
                  symmetrical = True, hatchOnly = True,
-                 progress = None, fraction = None, cancel = None):
-
-    board = randomCompleted(size, progress=progress, cancel=cancel)
+                 progress = None, fraction = None, cancel = None,
+                 pool = None, window = None, seed = None):
+    """Make a random puzzle by removing numbers from a random completed
+    board for as long as it stays uniquely solvable within maxBranch.
+
+    All randomness comes from a random.Random seeded with seed (chosen at
+    random if not given), and the board is filled with GENERATE_METHOD
+    whatever the solve method, so the same seed and options always give
+    the same puzzle. The seed is kept as the board's seed attribute and saved
+    by writeSudoku.
+
+    If a multiprocessing pool is given, upcoming removals are checked
+    window at a time on it (see removeSpeculatively). The puzzle is the
+    same as without a pool for the same seed.
+
+    The filling search and, without a pool, every removal check share one
+    SearchMonitor, so progress sees (and a SearchMonitor passed as
+    progress counts) all the searching done."""
+
+    if seed == None:
+        seed = random.randrange(1 << 31)
+    rng = random.Random(seed)
+    monitor = searchMonitor(progress, cancel)
+
+    board = randomCompleted(size, progress=monitor, cancel=cancel, rng=rng)
     width = size[0] * size[1]
     if symmetrical:
         cells = range(width * width / 2 + 1)
     else:
         cells = range(width * width)
 
-    random.shuffle(cells)
+    rng.shuffle(cells)
 
-    count = 0.0
+    if pool:
+        if not removeSpeculatively(board, cells, symmetrical, maxBranch,
+                                   hatchOnly, fraction, cancel, pool, window):
+            return None
+    else:
+        cache = DifficultyCache()
+        count = 0.0
 
-    for n in cells:
-        if fraction:
-            fraction(count / len(cells))
-            count += 1.0
-        if cancel:
-            if cancel():
-                return None
-            
-        x = n % width
-        y = n / width
+        for n in cells:
+            if fraction:
+                fraction(count / len(cells))
+                count += 1.0
+            if cancel:
+                if cancel():
+                    return None
 
-        cell = board[x, y]
-        value = cell.value
-        if not value:
-            continue
-        cell.setValue(None)
-
-        if symmetrical:
-            x2 = width - x - 1
-            y2 = width - y - 1
-            if x2 != x or y2 != y:
-                cell2 = board[x2, y2]
-                value2 = cell2.value
-                cell2.setValue(None)
-            else:
-                cell2 = None
+            indices = removalIndices(n, width, symmetrical)
+            if not board.cellValues[indices[0]]:
+                continue
 
-        if board.difficulty(maxBranch, hatchOnly) == None or \
-               board.solve(True, 2) != 1:
-            
-            cell.setValue(value)
-            if symmetrical and cell2:
-                cell2.setValue(value2)
+            values = [board.cellValues[i] for i in indices]
+            for i in indices:
+                board.flatCells[i].setValue(None)
+
+            if not removalAllowed(board, maxBranch, hatchOnly, cache, monitor):
+                for (i, value) in zip(indices, values):
+                    board.flatCells[i].setValue(value or None)
 
     for row in board.cells:
         for cell in row:
             if cell.value:
                 cell.state = CELL_PRESET
-    
+
+    board.seed = seed
+    if monitor and monitor is not progress:
+        monitor.finish()
     return board
+
+def removalIndices(n, width, symmetrical):
+    "Cells emptied by removing cell n: it and, if symmetrical, its partner."
+    indices = [n]
+    if symmetrical:
+        partner = width * width - n - 1
+        if partner != n:
+            indices.append(partner)
+    return indices
+
+def removalAllowed(board, maxBranch, hatchOnly, cache = None, monitor = None):
+    return board.difficulty(maxBranch, hatchOnly, progress = monitor,
+                            cache = cache) != None and \
+           board.solve(True, 2, method = SOLVE_DLX, progress = monitor) == 1
+
+# Each worker process keeps its own difficulty cache between checks.
+removalCache = None
+
+def checkRemoval(task):
+    "Check one removal for removeSpeculatively. Runs in a worker process."
+    global removalCache
+    if removalCache == None:
+        removalCache = DifficultyCache()
+
+    (shape, values, indices, maxBranch, hatchOnly) = task
+    board = BoardState(getGeometry(*shape), array('B', values), 0).board()
+    for i in indices:
+        board.flatCells[i].setValue(None)
+    return removalAllowed(board, maxBranch, hatchOnly, removalCache)
+
+def removeSpeculatively(board, cells, symmetrical, maxBranch, hatchOnly,
+                        fraction, cancel, pool, window = None):
+    """Removal loop for randomPuzzle that checks the next window candidates
+    at once on pool, each against a snapshot of the current board.
+    Removals are committed in the order of cells; once one is accepted the
+    checks after it are stale, so they are thrown away and redone against
+    the new board. Returns False if cancelled."""
+    if not window:
+        window = multiprocessing.cpu_count()
+
+    width = board.size[0]
+    shape = (board.regionSize, board.regionCount)
+    pos = 0
+
+    while pos < len(cells):
+        if fraction:
+            fraction(float(pos) / len(cells))
+        if cancel:
+            if cancel():
+                return False
+
+        batch = []
+        next = pos
+        while next < len(cells) and len(batch) < window:
+            indices = removalIndices(cells[next], width, symmetrical)
+            if board.cellValues[indices[0]]:
+                batch.append((next, indices))
+            next += 1
+        if not batch:
+            break
+
+        values = board.cellValues.tostring()
+        results = pool.map(checkRemoval,
+                           [(shape, values, indices, maxBranch, hatchOnly)
+                            for (n, indices) in batch])
+
+        pos = next
+        for ((n, indices), accepted) in zip(batch, results):
+            if accepted:
+                for i in indices:
+                    board.flatCells[i].setValue(None)
+                pos = n + 1
+                break
+
+    return True
             
 
+class DifficultyCache:
+    """Bounded LRU transposition table for calcDifficulty, mapping
+    (board shape, board hash, maxBranch, hatchOnly) to its (total, count)
+    result. Boards of any shape can share one cache."""
+
+    # Rough size of one entry (key, result and LRU bookkeeping) on
+    # 64-bit Python 2.7.
+    ENTRY_BYTES = 400
+
+    def __init__(self, maxBytes = 16 << 20):
+        self.maxEntries = max(1, maxBytes / self.ENTRY_BYTES)
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        result = self.entries.pop(key, None)
+        if result == None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries[key] = result
+        return result
+
+    def put(self, key, result):
+        self.entries[key] = result
+        if len(self.entries) > self.maxEntries:
+            self.entries.popitem(False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# Kinds of forced move counted by SolveStats.
+MOVE_EXCLUSION = 'exclusion'    # a cell with only one candidate
+MOVE_SCAN      = 'scan'         # the only place for a value in a row or column
+MOVE_HATCH     = 'hatch'        # the only place for a value in a region
+
+class SolveStats:
+    """Counters collected by SudokuBoard.solve and calcDifficulty when
+    passed one as their stats argument. One object can gather several
+    calls. Times are in seconds, by phase: 'setup' builds the solver,
+    'search' is the whole search and 'scan' the part of it spent looking
+    for forced moves ('propagate' for the propagating solver).
+
+    Depth counts branching decisions only: the guesses still open at
+    cells (or DLX columns) with more than one alternative. Forced moves
+    don't add to it, so every solver measures maxDepth the same way."""
+
+    def __init__(self):
+        self.nodes = 0
+        self.maxDepth = 0
+        self.guesses = 0
+        self.backtracks = 0
+        self.moves = {MOVE_EXCLUSION: 0, MOVE_SCAN: 0, MOVE_HATCH: 0}
+        self.cacheHits = 0
+        self.cacheMisses = 0
+        self.times = {}
+
+    def node(self, depth):
+        self.nodes += 1
+        if depth > self.maxDepth:
+            self.maxDepth = depth
+
+    def addTime(self, phase, start):
+        "Add the time since start (from time.time()) to a phase."
+        self.times[phase] = self.times.get(phase, 0.0) + time.time() - start
+
+    def asDict(self):
+        return {'nodes': self.nodes, 'maxDepth': self.maxDepth,
+                'guesses': self.guesses, 'backtracks': self.backtracks,
+                'moves': dict(self.moves), 'cacheHits': self.cacheHits,
+                'cacheMisses': self.cacheMisses,
+                'times': dict([(phase, round(seconds, 6))
+                               for (phase, seconds) in self.times.items()])}
+
+    def __repr__(self):
+        return 'SolveStats(%s)' % json.dumps(self.asDict(), sort_keys = True)
+
+
+# A search checks for cancellation every PROGRESS_NODES nodes, and reports
+# progress at most every PROGRESS_INTERVAL seconds.
+PROGRESS_NODES = 256
+PROGRESS_INTERVAL = 0.1
+
+class SearchMonitor:
+    """Rate-limited progress and cancel checks for a search, made from the
+    progress and cancel callbacks given to solve or calcDifficulty (see
+    searchMonitor). cancel() is called every `every` nodes; progress(monitor)
+    at most every `interval` seconds, with this object as its payload:
+    nodes visited, depth (the number of open guesses, as for SolveStats)
+    and fraction, an estimate of how much of the search tree has been
+    covered.
+
+    The search counts down countdown at each node and calls check() when
+    it reaches zero; check() returns True if the search should stop. Each
+    open guess is a [values tried, values to try] pair in branches."""
+
+    def __init__(self, progress = None, cancel = None,
+                 every = PROGRESS_NODES, interval = PROGRESS_INTERVAL):
+        self.progress = progress
+        self.cancel = cancel
+        self.every = every
+        self.interval = interval
+        self.countdown = every
+        self.counted = 0
+        self.cancelled = False
+        self.branches = []
+        self.start = time.time()
+        self.lastReport = self.start
+
+    def check(self):
+        if self.cancelled:
+            return True
+        self.counted += self.every
+        self.countdown = self.every
+        if self.cancel and self.cancel():
+            # Stop at every node from now on, so the search unwinds fast.
+            self.cancelled = True
+            self.countdown = 0
+            return True
+        if self.progress:
+            now = time.time()
+            if now - self.lastReport >= self.interval:
+                self.lastReport = now
+                self.progress(self)
+        return False
+
+    def finish(self):
+        "Report once more when a search ends, so short searches report too."
+        if self.progress and not self.cancelled:
+            self.lastReport = time.time()
+            self.progress(self)
+
+    def getNodes(self):
+        return self.counted + self.every - self.countdown
+    nodes = property(getNodes)
+
+    def getDepth(self):
+        depth = 0
+        for branch in self.branches:
+            if branch[1] > 1:
+                depth += 1
+        return depth
+    depth = property(getDepth)
+
+    def getFraction(self):
+        fraction = 0.0
+        weight = 1.0
+        for branch in self.branches:
+            fraction += weight * max(0, branch[0]) / branch[1]
+            weight /= branch[1]
+        return fraction
+    fraction = property(getFraction)
+
+    def getElapsed(self):
+        return time.time() - self.start
+    elapsed = property(getElapsed)
+
+def searchMonitor(progress, cancel):
+    """A SearchMonitor for a search's progress and cancel callbacks, or
+    None if there are neither (so the search does no extra work). A
+    SearchMonitor passed as progress is used as it is."""
+    if isinstance(progress, SearchMonitor):
+        return progress
+    if progress or cancel:
+        return SearchMonitor(progress, cancel)
+    return None
+
+
+class BoardGeometry:
+    """Index tables shared by every board of one shape. Cells are numbered
+    y * width + x; units are the columns, then rows, then regions, in the
+    same order as SudokuBoard.sets. Use getGeometry rather than creating
+    these directly."""
+
+    def __init__(self, regionSize, regionCount):
+        self.regionSize = regionSize
+        self.regionCount = regionCount
+        self.size = (regionSize[0] * regionCount[0], regionSize[1] * regionCount[1])
+        (width, height) = self.size
+        self.cellCount = width * height
+        self.values = regionSize[0] * regionSize[1]
+        self.allValues = (1 << self.values) - 1
+
+        self.coords = [(i % width, i / width) for i in range(self.cellCount)]
+
+        self.units = []
+        for x in range(width):
+            self.units.append([y * width + x for y in range(height)])
+        for y in range(height):
+            self.units.append([y * width + x for x in range(width)])
+
+        self.regionUnits = []
+        for yStart in range(0, height, regionSize[1]):
+            for xStart in range(0, width, regionSize[0]):
+                self.regionUnits.append(len(self.units))
+                self.units.append([y * width + x
+                                   for y in range(yStart, yStart + regionSize[1])
+                                   for x in range(xStart, xStart + regionSize[0])])
+
+        # Each cell's column, row and region, in that order.
+        self.cellUnits = [[] for i in range(self.cellCount)]
+        for u in range(len(self.units)):
+            for i in self.units[u]:
+                self.cellUnits[i].append(u)
+
+        self.peers = []
+        for i in range(self.cellCount):
+            peers = {}
+            for u in self.cellUnits[i]:
+                for j in self.units[u]:
+                    peers[j] = True
+            del peers[i]
+            self.peers.append(sorted(peers))
+
+        # Random 64-bit keys for Zobrist hashing, indexed by
+        # cell * (values + 1) + value. The seed is fixed by the full shape,
+        # so hashes are the same in every process and boards with the same
+        # cells but different regions (2x3 and 3x2) get different keys.
+        seed = 0
+        for n in tuple(regionSize) + tuple(regionCount):
+            seed = seed * 64 + n
+        rng = random.Random(seed)
+        self.zobrist = [rng.getrandbits(64)
+                        for i in range(self.cellCount * (self.values + 1))]
+
+    def index(self, (x, y)):
+        return y * self.size[0] + x
+
+
+geometries = {}
+
+def getGeometry(regionSize, regionCount):
+    key = (tuple(regionSize), tuple(regionCount))
+    geometry = geometries.get(key)
+    if not geometry:
+        geometry = BoardGeometry(*key)
+        geometries[key] = geometry
+    return geometry
+
+
+class BoardState(object):
+    """Compact copy of a board's contents: an array with one byte per cell
+    holding its value (0 for empty), and a bitmap of preset cells, both
+    indexed as in the BoardGeometry."""
+
+    __slots__ = ('geometry', 'values', 'presets')
+
+    def __init__(self, geometry, values, presets):
+        self.geometry = geometry
+        self.values = values
+        self.presets = presets
+
+    def board(self):
+        board = SudokuBoard(self.geometry.regionSize, self.geometry.regionCount)
+        board.restore(self)
+        return board
+
+
 class SudokuBoard:
     def __init__(self, regionSize = (3, 3), regionCount = (3, 3)):
+        self.geometry = getGeometry(regionSize, regionCount)
         self.regionSize = regionSize
         self.regionCount = regionCount
-        self.size = (regionSize[0] * regionCount[0], regionSize[1] * regionCount[1])
-        self.cellCount = self.size[0] * self.size[1]
+        self.size = self.geometry.size
+        self.cellCount = self.geometry.cellCount
         self.filled = 0
+
+        # Number of repeated values across all sets, kept up to date by
+        # ExclusionSet, so isValid needn't look at every set.
+        self.clashes = 0
+
+        # Seed randomPuzzle made this board from, if any.
+        self.seed = None
+
+        # Zobrist hashes of all filled cells and of preset cells only,
+        # kept up to date by SudokuCell. See stateHash.
+        self.hash = 0
+        self.presetHash = 0
         
-        self.values = regionSize[0] * regionSize[1]
+        self.values = self.geometry.values
+        self.allValues = self.geometry.allValues
 
-        self.cells = []       
-        for y in range(regionSize[1] * regionCount[1]):
-            row = []
-            self.cells.append(row)
-            for x in range(regionSize[0] * regionCount[0]):
-                row.append(SudokuCell(self, (x, y)))
+        # Cell contents live in these: a byte per cell holding its value
+        # (0 for empty) and a bitmap of preset cells.
+        self.cellValues = array('B', [0]) * self.cellCount
+        self.presets = 0
 
-        self.sets = []
-        # Columns
-        for x in range(self.size[0]):
-            set = ExclusionSet(self)
-            self.sets.append(set)
-            for y in range(self.size[1]):
-                set.add(self.cells[y][x])
-                
-        # Rows
+        self.flatCells = []
+        for i in range(self.cellCount):
+            self.flatCells.append(SudokuCell(self, self.geometry.coords[i], i))
+
+        self.cells = []
         for y in range(self.size[1]):
+            self.cells.append(self.flatCells[y * self.size[0]:(y + 1) * self.size[0]])
+
+        # Columns, rows then regions
+        self.sets = []
+        for unit in self.geometry.units:
             set = ExclusionSet(self)
             self.sets.append(set)
-            row = self.cells[y]
-            for cell in row:
-                set.add(cell)
-
-        self.regionSets = []
-        # Regions
-        for yStart in range(0, self.size[1], regionSize[1]):
-            for xStart in range(0, self.size[0], regionSize[0]):
-                set = ExclusionSet(self)
-                self.sets.append(set)
-                self.regionSets.append(set)
-                for y in range(yStart, yStart + regionSize[1]):
-                    for x in range(xStart, xStart + regionSize[0]):
-                        set.add(self.cells[y][x])
+            for i in unit:
+                set.add(self.flatCells[i])
+
+        self.regionSets = [self.sets[u] for u in self.geometry.regionUnits]
 
     def copy(self, presetOnly = False):
-        newBoard = SudokuBoard(self.regionSize, self.regionCount)
-        for y in range(self.size[1]):
-            for x in range(self.size[0]):
-                oldCell = self[x, y]
-                if (not presetOnly) or (oldCell.state == CELL_PRESET):
-                    newCell = newBoard[x, y]
-                    newCell.setValue(oldCell.value)
-                    newCell.state = oldCell.state
+        board = self.snapshot(presetOnly).board()
+        board.seed = self.seed
+        return board
 
-        return newBoard
+    def snapshot(self, presetOnly = False):
+        values = self.cellValues[:]
+        if presetOnly:
+            for i in range(self.cellCount):
+                if not (self.presets >> i) & 1:
+                    values[i] = 0
+        return BoardState(self.geometry, values, self.presets)
+
+    def restore(self, state):
+        "Replace the board's contents with a snapshot of the same shape."
+        if state.geometry is not self.geometry:
+            raise ValueError('Snapshot is for a different board shape')
+
+        self.cellValues[:] = state.values
+        self.presets = state.presets
+        self.filled = self.cellCount - self.cellValues.count(0)
+
+        values = self.cellValues
+        for cell in self.flatCells:
+            cell.value = values[cell.index] or None
+        self.clashes = 0
+        for (set, unit) in zip(self.sets, self.geometry.units):
+            useCount = array('B', [0]) * (self.values + 1)
+            for i in unit:
+                useCount[values[i]] += 1
+            useCount[0] = 0
+            used = 0
+            for value in range(1, self.values + 1):
+                if useCount[value]:
+                    used |= valueBit(value)
+                    self.clashes += useCount[value] - 1
+            set.useCount = useCount
+            set.used = used
+
+        zobrist = self.geometry.zobrist
+        stride = self.values + 1
+        self.hash = 0
+        self.presetHash = 0
+        for i in range(self.cellCount):
+            if values[i]:
+                key = zobrist[i * stride + values[i]]
+                self.hash ^= key
+                if (self.presets >> i) & 1:
+                    self.presetHash ^= key
+
+    def setValues(self, changes):
+        """Set many cells at once: changes is a list of (index, value,
+        preset), with value 0 for empty. Only the changed cells and their
+        sets are touched, so the cost is in proportion to len(changes)."""
+        cells = self.flatCells
+        for (i, value, preset) in changes:
+            cell = cells[i]
+            # Clear the preset bit first, so the preset hash only ever
+            # holds the final value.
+            cell.state = CELL_UNSET
+            cell.setValue(value or None)
+            if value and preset:
+                cell.state = CELL_PRESET
+
+    def stateHash(self, presetOnly = False):
+        """64-bit Zobrist hash of the filled cells (or only the preset
+        ones). Boards of the same shape with the same values hash the
+        same, in any process."""
+        if presetOnly:
+            return self.presetHash
+        return self.hash
 
     def isSolved(self):
         return self.filled == self.cellCount
 
     def isValid(self):
-        values = range(1, self.values + 1)
-        for set in self.sets:
-            available = values[:]
-            for cell in set.cells:
-                if cell.value:
-                    if not cell.value in available:
-                        return False
-                    available.remove(cell.value)
+        return not self.clashes
+
+    def toLine(self, presetOnly = False):
+        """The board on one line: a character per cell ('.' for empty,
+        then 1-9 and A-Z) for up to 35 values, or comma-separated numbers
+        for more. Boards with regions that aren't square start with a
+        'w,h:' prefix giving the region size."""
+        values = self.snapshot(presetOnly).values
+        if self.values < len(LINE_DIGITS):
+            line = ''.join([value and LINE_DIGITS[value] or '.'
+                            for value in values])
+        else:
+            line = ','.join([str(value) for value in values])
+        if self.regionSize[0] != self.regionSize[1]:
+            line = '%d,%d:%s' % (self.regionSize[0], self.regionSize[1], line)
+        return line
 
-        return True
+    def fromLine(line, regionSize = None):
+        return boardFromLine(line, regionSize)
+    fromLine = staticmethod(fromLine)
 
     def __repr__(self):
         
@@ -244,8 +868,9 @@ class SudokuBoard:
     def __setitem__(self, (x, y), value):
         self.cells[y][x].setValue(value)
 
-    def difficultyString(self, maxBranch = 0, progress = None, cancel = None):
-        diff = self.difficulty(maxBranch, False, progress, cancel)
+    def difficultyString(self, maxBranch = 0, progress = None, cancel = None,
+                         cache = None, stats = None):
+        diff = self.difficulty(maxBranch, False, progress, cancel, cache, stats)
 
         for (minDiff, string) in DIFFICULTY_STR:
             if (diff == None) or (minDiff == None) or (diff < minDiff):
@@ -254,9 +879,10 @@ class SudokuBoard:
         return DIFFICULTY_STR[-1][1]
 
     def difficulty(self, maxBranch = 0, hatchOnly = False,
-                   progress = None, cancel = None):
+                   progress = None, cancel = None, cache = None, stats = None):
         
-        (total, count) = self.calcDifficulty(maxBranch, hatchOnly, progress, cancel)
+        (total, count) = self.calcDifficulty(maxBranch, hatchOnly, progress,
+                                             cancel, cache, stats)
         if total < 0:
             return None
         elif count == 0:
@@ -264,85 +890,35 @@ class SudokuBoard:
         else:
             return float(total) / count
 
-    def calcDifficulty(self, maxBranch, hatchOnly, progress, cancel):
-        if progress:
-            progress()
-        if cancel:
-            if cancel():
-                return (-1, 0)
-        
-        if self.isSolved():
-            return (0, 0)
-        
-        if maxBranch < 0:
-            return (-1, 0)
-
-        # Cross-hatch moves
-        moves = self.logicalMoves(False, False, True).items()
-        if moves:
-            diff = 5 * len(moves)
-        elif not hatchOnly:
-            moves = self.logicalMoves(True, True, False).items()
-            diff = len(moves)
-
-        for (cell, value) in moves:
-            cell.setValue(value)
-
-        if moves:
-            (total, count) = self.calcDifficulty(maxBranch, hatchOnly, progress, cancel)
-
-        for (cell, value) in moves:
-            cell.setValue(None)
-            
-        if moves:
-            if total == -1:
-                return (-1, count + 1)
-            else:
-                return (total + diff, count + 1)
-
-        if maxBranch <= 0:
-            return (-1, 0)
-
-        nextCell = None
-        nextPossible = None
-
-        for row in self.cells:
-            for cell in row:
-                if not cell.value:
-                    possible = cell.possibleValues()
-                    if not possible:
-                        # Dead end
-                        return (-1, 0)
-                    if (not nextCell) or (len(possible) < len(nextPossible)):
-                        nextCell = cell
-                        nextPossible = possible
-
-        if not nextCell:
-            # Solved
-            return (0, 1)
-
-        total = 0
-        count = 1
-
-        if len(nextPossible) - 1 > maxBranch:
-            nextPossible = nextPossible[:maxBranch]
-            maxBranch = 0
-        else:
-            maxBranch -= len(nextPossible) - 1
-
-        for value in nextPossible:
-            nextCell.setValue(value)
-            (nextTotal, nextCount) = self.calcDifficulty(maxBranch, hatchOnly, progress, cancel)
-            if (nextTotal != -1):
-                total += nextTotal
-            count += nextCount
-            nextCell.setValue(None)
-
-        if count == 1:
-            return (-1, 1)
-        
-        return (total, count)
-
+    def calcDifficulty(self, maxBranch, hatchOnly, progress, cancel,
+                       cache = None, stats = None):
+        if stats:
+            start = time.time()
+        propagator = Propagator(self)
+        propagator.cache = cache
+        propagator.stats = stats
+        if stats:
+            stats.addTime('setup', start)
+            start = time.time()
+        monitor = searchMonitor(progress, cancel)
+        result = propagator.calcDifficulty(maxBranch, hatchOnly, monitor)
+        # A SearchMonitor passed in may span several searches; whoever made
+        # it reports the end.
+        if monitor and monitor is not progress:
+            monitor.finish()
+        if stats:
+            stats.addTime('search', start)
+        return result
+
+    def moveKind(self, cell, value):
+        """Which kind of forced move puts value in the empty cell, preferring
+        MOVE_EXCLUSION, then MOVE_HATCH, then MOVE_SCAN."""
+        if len(cell.possibleValues()) == 1:
+            return MOVE_EXCLUSION
+        region = cell.sets[2]
+        if (value, cell) in region.determinedValues():
+            return MOVE_HATCH
+        return MOVE_SCAN
 
     def logicalMoves(self, allScan = True, exclude = True, hatch = False, maxCount = 0):
         moves = {}
@@ -376,12 +952,59 @@ class SudokuBoard:
         return moves
     
     def solve(self, countOnly = False, maxCount = None, shuffle = False,
-              progress = None, cancel = None):
+              progress = None, cancel = None, method = None, rng = None,
+              stats = None):
+        """Find solutions (or just count them, if countOnly), stopping
+        after maxCount. With shuffle, the search order is randomised
+        using rng (a random.Random), or the random module if not given.
+        Search counters are added to stats, a SolveStats, if given.
+
+        progress, if given, is called now and then with a SearchMonitor
+        describing how far the search has got; cancel() is polled every
+        PROGRESS_NODES nodes and stops the search if it returns true.
+        progress is called once more when the search ends, unless it was
+        cancelled. A SearchMonitor can be passed as progress to count
+        several searches together; it is not finished here."""
+        if not method:
+            method = solveMethod
+        if not rng:
+            rng = random
+        if stats:
+            start = time.time()
+
+        if method == SOLVE_DLX:
+            solver = DancingLinks(self)
+        elif method == SOLVE_PROPAGATE:
+            solver = Propagator(self, True)
+        elif method == SOLVE_BACKTRACK:
+            solver = None
+        else:
+            raise ValueError('Unknown solve method: %s' % method)
+
+        if stats:
+            stats.addTime('setup', start)
+            start = time.time()
+        monitor = searchMonitor(progress, cancel)
+        if solver:
+            solutions = solver.solve(countOnly, maxCount, shuffle,
+                                     monitor, rng, stats)
+        else:
+            solutions = self.backtrackSolve(countOnly, maxCount, shuffle,
+                                            monitor, rng, stats)
+        if monitor and monitor is not progress:
+            monitor.finish()
+        if stats:
+            stats.addTime('search', start)
+        return solutions
 
-        if progress:
-            progress()
-        if cancel:
-            if cancel():
+    def backtrackSolve(self, countOnly = False, maxCount = None, shuffle = False,
+                       monitor = None, rng = random, stats = None, depth = 0):
+
+        if stats:
+            stats.node(depth)
+        if monitor:
+            monitor.countdown -= 1
+            if monitor.countdown <= 0 and monitor.check():
                 if countOnly:
                     return 0
                 else:
@@ -396,7 +1019,13 @@ class SudokuBoard:
         revert = []
         
         while True:
+            if stats:
+                start = time.time()
             moves = self.logicalMoves(maxCount = 1)
+            if stats:
+                for (cell, value) in moves.items():
+                    stats.moves[self.moveKind(cell, value)] += 1
+                stats.addTime('scan', start)
             if not moves:
                 break
 
@@ -409,18 +1038,20 @@ class SudokuBoard:
 
         if shuffle:
             rows = self.cells[:]
-            random.shuffle(rows)
+            rng.shuffle(rows)
         else:
             rows = self.cells
 
         for row in rows:
             if shuffle:
                 row = row[:]
-                random.shuffle(row)
+                rng.shuffle(row)
             for cell in row:
                 if not cell.value:
                     possible = cell.possibleValues()
                     if not possible:
+                        if stats:
+                            stats.backtracks += 1
                         for cell in revert:
                             cell.setValue(None)
                         if countOnly:
@@ -447,12 +1078,22 @@ class SudokuBoard:
             solutions = []
 
         if shuffle:
-            random.shuffle(nextPossible)
+            rng.shuffle(nextPossible)
+
+        if monitor:
+            branch = [0, len(nextPossible)]
+            monitor.branches.append(branch)
             
         for value in nextPossible:
+            if stats:
+                stats.guesses += 1
             nextCell.setValue(value)
-            solutions += self.solve(countOnly, maxCount, shuffle, progress, cancel)
+            solutions += self.backtrackSolve(countOnly, maxCount, shuffle,
+                                             monitor, rng, stats,
+                                             depth + (len(nextPossible) > 1))
             nextCell.setValue(None)
+            if monitor:
+                branch[0] += 1
 
             if maxCount != None:
                 if countOnly:
@@ -462,23 +1103,45 @@ class SudokuBoard:
                 if maxCount <= 0:
                     break
 
+        if monitor:
+            monitor.branches.pop()
+
         for cell in revert:
             cell.setValue(None)
             
         return solutions
         
 
-class SudokuCell:
-    "One cell of a Sudoku board."
+class SudokuCell(object):
+    """One cell of a Sudoku board. The state is stored in the board's
+    presets bitmap, and the value is mirrored in its cellValues."""
+
+    __slots__ = ('value', 'board', 'coord', 'index', 'sets')
     
-    def __init__(self, board, coord):
+    def __init__(self, board, coord, index):
         self.value = None
         self.board = board
         self.coord = coord
+        self.index = index
         self.sets = []
-        self.state = CELL_UNSET
 
-        self.clearCache()
+    def getState(self):
+        if (self.board.presets >> self.index) & 1:
+            return CELL_PRESET
+        return CELL_UNSET
+
+    def setState(self, state):
+        board = self.board
+        bit = 1 << self.index
+        wasPreset = bool(board.presets & bit)
+        if state == CELL_PRESET:
+            board.presets |= bit
+        else:
+            board.presets &= ~bit
+        if self.value and wasPreset != (state == CELL_PRESET):
+            board.presetHash ^= board.geometry.zobrist[self.index * (board.values + 1) + self.value]
+
+    state = property(getState, setState)
 
     def __repr__(self):
         return str(self.coord)
@@ -492,106 +1155,829 @@ class SudokuCell:
         # been warned.
         return cmp(self.coord, other.coord)
 
-    def possibleValues(self, excludeSelf = False):
+    def candidates(self, excludeSelf = False):
+        "Bitmask of the values this cell could hold (see valueBit)."
         if excludeSelf:
-            possible = None
-            exclude = self
+            used = 0
+            for set in self.sets:
+                used |= set.usedMask(self)
         else:
-            possible = self.cachedPossibleValues
-            exclude = None
-
-        if possible == None:
-            possible = range(1, self.board.values + 1)
+            (col, row, region) = self.sets
+            used = col.used | row.used | region.used
 
-            for set in self.sets:
-                possible = [value for value in possible if set.isAvailable(value, exclude)]
+        return self.board.allValues & ~used
 
-        if not excludeSelf:
-            self.cachedPossibleValues = possible
-            
-        return possible
+    def possibleValues(self, excludeSelf = False):
+        return maskValues(self.candidates(excludeSelf))
 
     def couldBe(self, value):
         if self.value:
             return self.value == value
 
-        #if self.cachedPossibleValues != None:
-        #    return value in self.cachedPossibleValues
-        
-        #for set in self.sets:
-        #    if not set.isAvailable(value):
-        #        return False
-        
-        #return True
-
-        return value in self.possibleValues()
+        return bool(self.candidates() & valueBit(value))
 
     def setValue(self, value):
-        if value and not self.value:
-            self.board.filled += 1
-        elif self.value and not value:
-            self.board.filled -= 1
-        
-        for set in self.sets:
-            if value and not self.value:
-                set.cachedIsAvailable[value - 1] = False
-            else:
-                set.clearCache()
-            for cell in set.cells:
-                cell.clearCache()
+        oldValue = self.value
+        if value == oldValue:
+            return
+
+        board = self.board
+        zobrist = board.geometry.zobrist
+        base = self.index * (board.values + 1)
+        change = 0
+
+        if oldValue:
+            for set in self.sets:
+                set.releaseValue(oldValue)
+            change = zobrist[base + oldValue]
+        else:
+            board.filled += 1
+
+        if value:
+            for set in self.sets:
+                set.useValue(value)
+            change ^= zobrist[base + value]
+        else:
+            board.filled -= 1
+
+        board.hash ^= change
+        if (board.presets >> self.index) & 1:
+            board.presetHash ^= change
 
         self.value = value
-        
-    def clearCache(self):
-        self.cachedPossibleValues = None
+        board.cellValues[self.index] = value or 0
+
+
+class ExclusionSet(object):
+    __slots__ = ('board', 'cells', 'used', 'useCount')
 
-class ExclusionSet:
     def __init__(self, board):
         self.board = board
         self.cells = []
 
-        self.cachedIsAvailable = [None] * self.board.values
+        # Bitmask of values held by cells in this set, along with a count
+        # per value so that invalid (duplicated) values release properly.
+        self.used = 0
+        self.useCount = array('B', [0]) * (self.board.values + 1)
         
     def isAvailable(self, value, exclude = None):
-        if not exclude:
-            cached = self.cachedIsAvailable[value - 1]
-            if cached != None:
-                return cached
+        if exclude and exclude.value == value:
+            return self.useCount[value] <= 1
 
-        available = True
-        for cell in self.cells:
-            if (not cell is exclude) and (cell.value == value):
-                available = False
-                break
+        return not (self.used & valueBit(value))
+
+    def usedMask(self, exclude = None):
+        "Bitmask of used values, ignoring the value held by exclude."
+        if exclude and exclude.value and self.useCount[exclude.value] == 1:
+            return self.used & ~valueBit(exclude.value)
 
-        if not exclude:
-            self.cachedIsAvailable[value - 1] = available
+        return self.used
 
-        return available
+    def useValue(self, value):
+        self.useCount[value] += 1
+        if self.useCount[value] > 1:
+            self.board.clashes += 1
+        self.used |= valueBit(value)
+
+    def releaseValue(self, value):
+        self.useCount[value] -= 1
+        if self.useCount[value]:
+            self.board.clashes -= 1
+        else:
+            self.used &= ~valueBit(value)
 
     def add(self, cell):
         self.cells.append(cell)
         cell.sets.append(self)
 
     def determinedValues(self):
+        # Values that only one cell in the set could hold: seen once
+        # but never twice while OR-ing together every cell's candidates.
+        once = 0
+        twice = 0
+        for cell in self.cells:
+            if cell.value:
+                mask = valueBit(cell.value)
+            else:
+                mask = cell.candidates()
+            twice |= once & mask
+            once |= mask
+
         determined = []
-        for value in range(1, self.board.values + 1):
-            possibleCell = None
+        for value in maskValues(once & ~twice):
             for cell in self.cells:
                 if cell.couldBe(value):
-                    if not possibleCell:
-                        possibleCell = cell
+                    determined.append((value, cell))
+                    break
+
+        return determined
+
+
+class Propagator:
+    """Flat, incrementally maintained view of a board for searching.
+
+    Cells and units are numbered as in the board's BoardGeometry. Each
+    empty cell's candidate mask, each unit's used-value mask and the
+    number of places left for each value in each unit are updated as
+    values are assigned. Every change is recorded on a trail, so undoing
+    back to a mark just pops the changes made since.
+
+    With autoPropagate set, naked and hidden singles are queued as soon as
+    a candidate disappears and assigned by propagate()."""
+
+    def __init__(self, board, autoPropagate = False):
+        self.board = board
+        self.autoPropagate = autoPropagate
+
+        geometry = board.geometry
+        self.cellCount = geometry.cellCount
+        self.stride = board.values + 1
+
+        self.regionUnits = geometry.regionUnits
+        self.allUnits = range(len(geometry.units))
+        self.unitCells = geometry.units
+        self.cellUnits = geometry.cellUnits
+        self.peers = geometry.peers
+
+        self.cells = board.flatCells
+        self.value = board.cellValues[:]
+        self.candidates = []
+        for cell in self.cells:
+            if cell.value:
+                self.candidates.append(0)
+            else:
+                self.candidates.append(cell.candidates())
+        self.filled = board.filled
+
+        # The board's Zobrist hash, kept up to date by assign/undo.
+        self.zobrist = geometry.zobrist
+        self.hash = board.stateHash()
+        self.shape = (tuple(geometry.regionSize), tuple(geometry.regionCount))
+
+        # Optional DifficultyCache for calcDifficulty, and SolveStats.
+        self.cache = None
+        self.stats = None
+        self.depth = 0
+
+        self.used = [set.used for set in board.sets]
+        self.places = [0] * (len(board.sets) * self.stride)
+        for i in range(self.cellCount):
+            for u in self.cellUnits[i]:
+                for value in maskValues(self.candidates[i]):
+                    self.places[u * self.stride + value] += 1
+
+        self.trail = []
+        self.queue = []
+        self.conflict = False
+        self.cancelled = False
+        self.rng = random
+
+        if autoPropagate:
+            for i in range(self.cellCount):
+                if not self.value[i]:
+                    self.checkCell(i)
+            for u in self.allUnits:
+                for value in maskValues(board.allValues & ~self.used[u]):
+                    self.checkPlaces(u, value)
+
+    def mark(self):
+        return len(self.trail)
+
+    def undo(self, mark):
+        trail = self.trail
+        value = self.value
+        while len(trail) > mark:
+            (array, i, old) = trail.pop()
+            if array is value:
+                self.filled -= 1
+                self.hash ^= self.zobrist[i * self.stride + value[i]]
+            array[i] = old
+        self.queue = []
+        self.conflict = False
+
+    def assign(self, i, value):
+        "Fill cell i with value, removing it from the peers' candidates."
+        trail = self.trail
+        bit = valueBit(value)
+
+        trail.append((self.value, i, 0))
+        self.value[i] = value
+        self.filled += 1
+        self.hash ^= self.zobrist[i * self.stride + value]
+
+        for u in self.cellUnits[i]:
+            trail.append((self.used, u, self.used[u]))
+            self.used[u] |= bit
+
+        # The cell itself no longer offers any place for its candidates.
+        mask = self.candidates[i]
+        trail.append((self.candidates, i, mask))
+        self.candidates[i] = 0
+        for u in self.cellUnits[i]:
+            for other in maskValues(mask):
+                self.removePlace(u, other)
+
+        candidates = self.candidates
+        for peer in self.peers[i]:
+            if candidates[peer] & bit:
+                trail.append((candidates, peer, candidates[peer]))
+                candidates[peer] &= ~bit
+                if self.autoPropagate:
+                    self.checkCell(peer)
+                for u in self.cellUnits[peer]:
+                    self.removePlace(u, value)
+
+    def removePlace(self, u, value):
+        k = u * self.stride + value
+        self.trail.append((self.places, k, self.places[k]))
+        self.places[k] -= 1
+        if self.autoPropagate:
+            self.checkPlaces(u, value)
+
+    def checkCell(self, i):
+        mask = self.candidates[i]
+        if not mask:
+            self.conflict = True
+        elif not (mask & (mask - 1)):
+            self.queue.append((i, lowestValue(mask)))
+
+    def checkPlaces(self, u, value):
+        if self.used[u] & valueBit(value):
+            return
+        places = self.places[u * self.stride + value]
+        if places == 0:
+            self.conflict = True
+        elif places == 1:
+            self.queue.append((self.unitPlace(u, value), value))
+
+    def unitPlace(self, u, value):
+        "The first empty cell in unit u that could hold value."
+        bit = valueBit(value)
+        for i in self.unitCells[u]:
+            if self.candidates[i] & bit:
+                return i
+        return None
+
+    def propagate(self):
+        "Assign queued singles until none are left. False on contradiction."
+        stats = self.stats
+        if stats:
+            start = time.time()
+        queue = self.queue
+        while queue and not self.conflict:
+            (i, value) = queue.pop()
+            if self.value[i]:
+                if self.value[i] != value:
+                    self.conflict = True
+            elif self.candidates[i] & valueBit(value):
+                if stats:
+                    stats.moves[self.moveKind(i, value)] += 1
+                self.assign(i, value)
+            else:
+                self.conflict = True
+        self.queue = []
+        if stats:
+            stats.addTime('propagate', start)
+        return not self.conflict
+
+    def place(self, i, value):
+        self.assign(i, value)
+        return self.propagate()
+
+    def isSolved(self):
+        return self.filled == self.cellCount
+
+    def moveKind(self, i, value):
+        """Which kind of forced move puts value in empty cell i, preferring
+        MOVE_EXCLUSION, then MOVE_HATCH, then MOVE_SCAN."""
+        mask = self.candidates[i]
+        if not (mask & (mask - 1)):
+            return MOVE_EXCLUSION
+        region = self.cellUnits[i][2]
+        if self.places[region * self.stride + value] == 1:
+            return MOVE_HATCH
+        return MOVE_SCAN
+
+    def nakedSingles(self):
+        moves = {}
+        for i in range(self.cellCount):
+            mask = self.candidates[i]
+            if mask and not self.value[i] and not (mask & (mask - 1)):
+                moves[i] = lowestValue(mask)
+        return moves
+
+    def hiddenSingles(self, units, moves = None):
+        if moves == None:
+            moves = {}
+        allValues = self.board.allValues
+        for u in units:
+            base = u * self.stride
+            for value in maskValues(allValues & ~self.used[u]):
+                if self.places[base + value] == 1:
+                    moves[self.unitPlace(u, value)] = value
+        return moves
+
+    def bestCell(self, shuffle = False):
+        """Empty cell with the fewest candidates. Returns (None, None) if
+        the board is full and (None, 0) if some cell has no candidates."""
+        best = None
+        bestCount = None
+        if shuffle:
+            order = range(self.cellCount)
+            self.rng.shuffle(order)
+        else:
+            order = xrange(self.cellCount)
+        for i in order:
+            if not self.value[i]:
+                count = popCount(self.candidates[i])
+                if not count:
+                    return (None, 0)
+                if (best == None) or (count < bestCount):
+                    best = i
+                    bestCount = count
+        return (best, bestCount)
+
+    def solution(self):
+        return BoardState(self.board.geometry, self.value[:],
+                          self.board.presets).board()
+
+    def solve(self, countOnly = False, maxCount = None, shuffle = False,
+              monitor = None, rng = random, stats = None):
+        if countOnly:
+            solutions = 0
+        else:
+            solutions = []
+
+        self.stats = stats
+        if ((maxCount != None) and (maxCount <= 0)) or not self.propagate():
+            return solutions
+
+        self.cancelled = False
+        self.rng = rng
+        return self.search(solutions, countOnly, maxCount, shuffle, monitor)
+
+    def search(self, solutions, countOnly, maxCount, shuffle, monitor):
+        stats = self.stats
+        if stats:
+            stats.node(self.depth)
+        if monitor:
+            monitor.countdown -= 1
+            if monitor.countdown <= 0 and monitor.check():
+                self.cancelled = True
+                return solutions
+
+        (i, count) = self.bestCell(shuffle)
+        if i == None:
+            if count == None:
+                if countOnly:
+                    solutions += 1
+                else:
+                    solutions.append(self.solution())
+            elif stats:
+                stats.backtracks += 1
+            return solutions
+
+        possible = maskValues(self.candidates[i])
+        if shuffle:
+            self.rng.shuffle(possible)
+        guess = int(len(possible) > 1)
+
+        if monitor:
+            branch = [0, len(possible)]
+            monitor.branches.append(branch)
+
+        for value in possible:
+            if stats:
+                stats.guesses += 1
+            mark = self.mark()
+            if self.place(i, value):
+                self.depth += guess
+                solutions = self.search(solutions, countOnly, maxCount, shuffle,
+                                        monitor)
+                self.depth -= guess
+            elif stats:
+                stats.backtracks += 1
+            self.undo(mark)
+            if monitor:
+                branch[0] += 1
+
+            if self.cancelled:
+                break
+            if maxCount != None:
+                if countOnly:
+                    found = solutions
+                else:
+                    found = len(solutions)
+                if found >= maxCount:
+                    break
+
+        if monitor:
+            monitor.branches.pop()
+
+        return solutions
+
+    def calcDifficulty(self, maxBranch, hatchOnly, monitor):
+        if self.cache == None:
+            return self.evaluateDifficulty(maxBranch, hatchOnly, monitor)
+
+        # Hashes only identify a board among boards of the same shape:
+        # every empty board hashes to 0.
+        key = (self.shape, self.hash, maxBranch, hatchOnly)
+        result = self.cache.get(key)
+        if self.stats:
+            if result == None:
+                self.stats.cacheMisses += 1
+            else:
+                self.stats.cacheHits += 1
+        if result == None:
+            self.cancelled = False
+            result = self.evaluateDifficulty(maxBranch, hatchOnly, monitor)
+            # A cancelled search leaves partial results behind.
+            if not self.cancelled:
+                self.cache.put(key, result)
+        return result
+
+    def evaluateDifficulty(self, maxBranch, hatchOnly, monitor):
+        stats = self.stats
+        if stats:
+            stats.node(self.depth)
+        if monitor:
+            monitor.countdown -= 1
+            if monitor.countdown <= 0 and monitor.check():
+                self.cancelled = True
+                return (-1, 0)
+        
+        if self.isSolved():
+            return (0, 0)
+        
+        if maxBranch < 0:
+            return (-1, 0)
+
+        if stats:
+            start = time.time()
+
+        # Cross-hatch moves
+        moves = self.hiddenSingles(self.regionUnits).items()
+        if moves:
+            diff = 5 * len(moves)
+            if stats:
+                stats.moves[MOVE_HATCH] += len(moves)
+        elif not hatchOnly:
+            moves = self.hiddenSingles(self.allUnits, self.nakedSingles()).items()
+            diff = len(moves)
+            if stats:
+                for (i, value) in moves:
+                    stats.moves[self.moveKind(i, value)] += 1
+
+        if stats:
+            stats.addTime('scan', start)
+
+        if moves:
+            mark = self.mark()
+            for (i, value) in moves:
+                self.assign(i, value)
+
+            (total, count) = self.calcDifficulty(maxBranch, hatchOnly, monitor)
+
+            self.undo(mark)
+
+            if total == -1:
+                return (-1, count + 1)
+            else:
+                return (total + diff, count + 1)
+
+        if maxBranch <= 0:
+            return (-1, 0)
+
+        (nextCell, possibleCount) = self.bestCell()
+        if nextCell == None:
+            if possibleCount == 0:
+                # Dead end
+                if stats:
+                    stats.backtracks += 1
+                return (-1, 0)
+            # Solved
+            return (0, 1)
+
+        nextPossible = maskValues(self.candidates[nextCell])
+
+        total = 0
+        count = 1
+
+        if len(nextPossible) - 1 > maxBranch:
+            nextPossible = nextPossible[:maxBranch]
+            maxBranch = 0
+        else:
+            maxBranch -= len(nextPossible) - 1
+
+        if monitor:
+            branch = [0, len(nextPossible)]
+            monitor.branches.append(branch)
+
+        guess = int(len(nextPossible) > 1)
+        for value in nextPossible:
+            if stats:
+                stats.guesses += 1
+            mark = self.mark()
+            self.assign(nextCell, value)
+            self.depth += guess
+            (nextTotal, nextCount) = self.calcDifficulty(maxBranch, hatchOnly, monitor)
+            self.depth -= guess
+            if (nextTotal != -1):
+                total += nextTotal
+            count += nextCount
+            self.undo(mark)
+            if monitor:
+                branch[0] += 1
+
+        if monitor:
+            monitor.branches.pop()
+
+        if count == 1:
+            return (-1, 1)
+        
+        return (total, count)
+
+
+class DancingLinks:
+    """Exact cover solver for a board, using Knuth's Algorithm X with
+    dancing links. There is one column per cell and one per value in each
+    row, column and region, and one matrix row per candidate value of each
+    empty cell. Constraints already met by filled cells are left out.
+
+    A board that already repeats a value has no solution, and is rejected
+    before searching:
+
+    >>> board = SudokuBoard()
+    >>> board[0, 0] = 1
+    >>> board[1, 0] = 1
+    >>> solver = DancingLinks(board)
+    >>> solver.impossible, solver.solve(), solver.solve(countOnly = True)
+    (True, [], 0)
+    """
+
+    def __init__(self, board):
+        self.board = board
+        geometry = board.geometry
+
+        # Node 0 is the root; column headers follow it.
+        self.left = [0]
+        self.right = [0]
+        self.up = [0]
+        self.down = [0]
+        self.column = [0]
+        self.count = [0]
+        self.choice = [None]
+
+        # The kind of forced move a column stands for, when it has only
+        # one row left, by header node.
+        self.kinds = [None]
+
+        self.headers = {}
+        # A repeated value can never be part of an exact cover, but the
+        # search could take a very long time to prove it.
+        self.impossible = not board.isValid()
+
+        # Constraint keys: the cell index for "cell is filled", and
+        # cellCount + unit * stride + value for "unit holds value".
+        base = geometry.cellCount
+        stride = board.values + 1
+
+        rows = []
+        for cell in board.flatCells:
+            if cell.value:
+                continue
+            possible = cell.possibleValues()
+            if not possible:
+                self.impossible = True
+            i = cell.index
+            units = geometry.cellUnits[i]
+            for value in possible:
+                constraints = [i]
+                for u in units:
+                    constraints.append(base + u * stride + value)
+                rows.append(((cell, value), constraints))
+
+        regionUnits = dict.fromkeys(geometry.regionUnits)
+        for (choice, constraints) in rows:
+            for key in constraints:
+                if key not in self.headers:
+                    if key < base:
+                        kind = MOVE_EXCLUSION
+                    elif (key - base) / stride in regionUnits:
+                        kind = MOVE_HATCH
                     else:
-                        possibleCell = None
+                        kind = MOVE_SCAN
+                    self.addHeader(key, kind)
+
+        # Every value missing from a unit must be placed in it, so if no
+        # candidate can supply one there is no solution at all.
+        for u in range(len(board.sets)):
+            for value in maskValues(board.allValues & ~board.sets[u].used):
+                if base + u * stride + value not in self.headers:
+                    self.impossible = True
+
+        for (choice, constraints) in rows:
+            self.addRow(choice, [self.headers[key] for key in constraints])
+
+    def addHeader(self, key, kind = None):
+        node = len(self.left)
+        self.headers[key] = node
+        self.left.append(self.left[0])
+        self.right.append(0)
+        self.right[self.left[0]] = node
+        self.left[0] = node
+        self.up.append(node)
+        self.down.append(node)
+        self.column.append(node)
+        self.count.append(0)
+        self.choice.append(None)
+        self.kinds.append(kind)
+
+    def addRow(self, choice, headers):
+        first = None
+        for header in headers:
+            node = len(self.left)
+            self.column.append(header)
+            self.choice.append(choice)
+            self.kinds.append(None)
+            self.count[header] += 1
+
+            self.up.append(self.up[header])
+            self.down.append(header)
+            self.down[self.up[header]] = node
+            self.up[header] = node
+
+            if first == None:
+                first = node
+                self.left.append(node)
+                self.right.append(node)
+            else:
+                self.left.append(self.left[first])
+                self.right.append(first)
+                self.right[self.left[first]] = node
+                self.left[first] = node
+
+    def cover(self, header):
+        left = self.left
+        right = self.right
+        up = self.up
+        down = self.down
+        column = self.column
+        count = self.count
+
+        right[left[header]] = right[header]
+        left[right[header]] = left[header]
+        i = down[header]
+        while i != header:
+            j = right[i]
+            while j != i:
+                down[up[j]] = down[j]
+                up[down[j]] = up[j]
+                count[column[j]] -= 1
+                j = right[j]
+            i = down[i]
+
+    def uncover(self, header):
+        left = self.left
+        right = self.right
+        up = self.up
+        down = self.down
+        column = self.column
+        count = self.count
+
+        i = up[header]
+        while i != header:
+            j = left[i]
+            while j != i:
+                count[column[j]] += 1
+                down[up[j]] = j
+                up[down[j]] = j
+                j = left[j]
+            i = up[i]
+        right[left[header]] = header
+        left[right[header]] = header
+
+    def chooseColumn(self):
+        best = None
+        header = self.right[0]
+        while header != 0:
+            if (best == None) or (self.count[header] < self.count[best]):
+                best = header
+                if self.count[best] <= 1:
+                    break
+            header = self.right[header]
+        return best
+
+    def solution(self, chosen):
+        state = self.board.snapshot()
+        for node in chosen:
+            (cell, value) = self.choice[node]
+            state.values[cell.index] = value
+        return state.board()
+
+    def solve(self, countOnly = False, maxCount = None, shuffle = False,
+              monitor = None, rng = random, stats = None):
+        if countOnly:
+            solutions = 0
+        else:
+            solutions = []
+
+        if self.impossible or ((maxCount != None) and (maxCount <= 0)):
+            return solutions
+
+        right = self.right
+        found = 0
+        chosen = []
+        # Each frame is [index of current row, number of rows, column
+        # header, rows to try]. Frames are also pushed on the monitor's
+        # branches, which reads the first two.
+        stack = []
+        if monitor:
+            branches = monitor.branches
+            base = len(branches)
+        # Frames with more than one row are guesses; see SolveStats.
+        depth = 0
+        descend = True
+
+        while True:
+            if descend:
+                if stats:
+                    stats.node(depth)
+                if monitor:
+                    monitor.countdown -= 1
+                    if monitor.countdown <= 0 and monitor.check():
                         break
-            if possibleCell:
-                determined.append((value, possibleCell))
 
-        return determined
+                if right[0] == 0:
+                    found += 1
+                    if countOnly:
+                        solutions += 1
+                    else:
+                        solutions.append(self.solution(chosen))
+                    if (maxCount != None) and (found >= maxCount):
+                        break
+                    descend = False
+                    continue
+
+                header = self.chooseColumn()
+                if self.count[header] == 0:
+                    if stats:
+                        stats.backtracks += 1
+                    descend = False
+                    continue
+                if stats and self.count[header] == 1:
+                    stats.moves[self.kinds[header]] += 1
+
+                self.cover(header)
+                rows = []
+                node = self.down[header]
+                while node != header:
+                    rows.append(node)
+                    node = self.down[node]
+                if shuffle:
+                    rng.shuffle(rows)
+                frame = [-1, len(rows), header, rows]
+                stack.append(frame)
+                if len(rows) > 1:
+                    depth += 1
+                if monitor:
+                    branches.append(frame)
+
+            if not stack:
+                break
 
-    def clearCache(self):
-        for i in range(len(self.cachedIsAvailable)):
-            self.cachedIsAvailable[i] = None
+            frame = stack[-1]
+            if frame[0] >= 0:
+                node = chosen.pop()
+                j = self.left[node]
+                while j != node:
+                    self.uncover(self.column[j])
+                    j = self.left[j]
+
+            frame[0] += 1
+            if frame[0] < frame[1]:
+                if stats and frame[1] > 1:
+                    stats.guesses += 1
+                node = frame[3][frame[0]]
+                chosen.append(node)
+                j = right[node]
+                while j != node:
+                    self.cover(self.column[j])
+                    j = right[j]
+                descend = True
+            else:
+                self.uncover(frame[2])
+                stack.pop()
+                if frame[1] > 1:
+                    depth -= 1
+                if monitor:
+                    branches.pop()
+                descend = False
+
+        if monitor:
+            del branches[base:]
+        return solutions
 
 
 def sample():
@@ -636,7 +2022,718 @@ def sample():
 #four = readSudoku('4x4.txt', (4,4), (4,4))
 #sList = [s1, s2, s3, s4, s5, s6]
 
+# Profiling hooks. enableProfiling() (or setting SUDOKU_PROFILE to an
+# output file name before importing this module) replaces the methods in
+# PROFILE_HOOKS with timed wrappers; disableProfiling() puts the originals
+# back, so when profiling is off nothing is wrapped and there is no cost.
+
+PROFILE_HOOKS = [(SudokuBoard, 'solve'),
+                 (SudokuBoard, 'calcDifficulty'),
+                 (SudokuBoard, 'logicalMoves'),
+                 (ExclusionSet, 'determinedValues'),
+                 (SudokuCell, 'possibleValues'),
+                 (SudokuCell, 'setValue'),
+                 (Propagator, '__init__'),
+                 (Propagator, 'solve'),
+                 (Propagator, 'search'),
+                 (Propagator, 'calcDifficulty'),
+                 (Propagator, 'evaluateDifficulty'),
+                 (Propagator, 'propagate'),
+                 (Propagator, 'assign'),
+                 (Propagator, 'undo'),
+                 (Propagator, 'hiddenSingles'),
+                 (Propagator, 'bestCell'),
+                 (DancingLinks, '__init__'),
+                 (DancingLinks, 'solve'),
+                 (DancingLinks, 'chooseColumn'),
+                 (DancingLinks, 'cover'),
+                 (DancingLinks, 'uncover')]
+
+class Profiler:
+    """Call counts and times for the hooked methods, by method, by caller
+    and by stack of hooked calls. Methods are named like 'SudokuCell.setValue'.
+    Worker processes forked by multiprocessing start with empty counts."""
+
+    def __init__(self):
+        self.functions = {}
+        self.output = None
+        self.reset()
+        multiprocessing.util.register_after_fork(self, Profiler.afterFork)
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.stack = []
+        self.active = {}
+        # name -> [calls, primitive (non-recursive) calls, own time, total time]
+        self.calls = {}
+        # (caller, name) -> [calls, own time, total time]
+        self.callers = {}
+        # 'outer;inner' stack -> own time
+        self.folded = {}
+
+    def call(self, name, function, args, kwargs):
+        stack = self.stack
+        frame = [name, 0.0]
+        stack.append(frame)
+        self.active[name] = self.active.get(name, 0) + 1
+        start = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            own = elapsed - frame[1]
+            path = ';'.join([f[0] for f in stack])
+            stack.pop()
+            self.active[name] -= 1
+            outermost = not self.active[name]
+
+            if name not in self.calls:
+                self.calls[name] = [0, 0, 0.0, 0.0]
+            counts = self.calls[name]
+            counts[0] += 1
+            counts[2] += own
+            if outermost:
+                counts[1] += 1
+                counts[3] += elapsed
+
+            if stack:
+                stack[-1][1] += elapsed
+                key = (stack[-1][0], name)
+                if key not in self.callers:
+                    self.callers[key] = [0, 0.0, 0.0]
+                counts = self.callers[key]
+                counts[0] += 1
+                counts[1] += own
+                counts[2] += elapsed
+
+            self.folded[path] = self.folded.get(path, 0.0) + own
+
+    def report(self, out = sys.stdout):
+        "Print a table of calls and times, slowest (own time) first."
+        print >> out, '%-32s %10s %10s %10s %10s' % ('', 'calls', 'own',
+                                                     'total', 'per call')
+        rows = sorted(self.calls.items(), key = lambda item: -item[1][2])
+        for (name, (calls, primitive, own, total)) in rows:
+            print >> out, '%-32s %10d %10.4f %10.4f %10.6f' % (
+                name, calls, own, total, own / calls)
+
+    def writeFolded(self, out):
+        """Write stacks in the folded format read by flamegraph.pl, with
+        times in microseconds."""
+        for path in sorted(self.folded):
+            print >> out, '%s %d' % (path, round(self.folded[path] * 1e6))
+
+    def pstats(self):
+        """The counts in the form pstats.Stats loads from a cProfile dump:
+        {(file, line, name): (primitive calls, calls, own time, total time,
+        {caller: (calls, primitive calls, own time, total time)})}."""
+        stats = {}
+        for (name, (calls, primitive, own, total)) in self.calls.items():
+            stats[self.functions[name]] = (primitive, calls, own, total, {})
+        for ((caller, name), (calls, own, total)) in self.callers.items():
+            callers = stats[self.functions[name]][4]
+            callers[self.functions[caller]] = (calls, calls, own, total)
+        return stats
+
+    def write(self, filename):
+        """Write the profile: folded stacks if filename ends in '.folded',
+        the report if it ends in '.txt', and otherwise a dump that
+        pstats.Stats can load. '%p' in filename is replaced by the process
+        id."""
+        filename = filename.replace('%p', str(os.getpid()))
+        if filename.endswith('.folded') or filename.endswith('.txt'):
+            out = file(filename, 'w')
+            if filename.endswith('.txt'):
+                self.report(out)
+            else:
+                self.writeFolded(out)
+        else:
+            out = file(filename, 'wb')
+            marshal.dump(self.pstats(), out)
+        out.close()
+
+    def writeIfCounted(self, filename):
+        """write, unless no hooked calls were made: a parent process that
+        left all the work to a pool has nothing to report, and would leave
+        an empty dump that pstats can't load."""
+        if self.calls:
+            self.write(filename)
+
+    def writeAtExit(self, filename):
+        "Write the profile when this process exits, if it counted anything."
+        self.output = filename
+        multiprocessing.util.Finalize(None, self.writeIfCounted, (filename,),
+                                      exitpriority = 10)
+
+    def afterFork(self):
+        self.reset()
+        if self.output:
+            output = self.output
+            if '%p' not in output:
+                (base, extension) = os.path.splitext(output)
+                output = '%s.%d%s' % (base, self.pid, extension)
+            self.writeAtExit(output)
+
+
+activeProfiler = None
+
+def profiledMethod(profiler, name, function):
+    def method(*args, **kwargs):
+        return profiler.call(name, function, args, kwargs)
+    method.__name__ = function.__name__
+    method.__doc__ = function.__doc__
+    return method
+
+def enableProfiling(profiler = None):
+    """Start counting calls to the methods in PROFILE_HOOKS, into profiler
+    (a new Profiler if not given). Returns the Profiler in use."""
+    global activeProfiler
+    if activeProfiler:
+        return activeProfiler
+    if profiler == None:
+        profiler = Profiler()
+
+    profiler.originals = []
+    for (cls, methodName) in PROFILE_HOOKS:
+        function = cls.__dict__[methodName]
+        name = '%s.%s' % (cls.__name__, methodName)
+        code = function.func_code
+        profiler.functions[name] = (code.co_filename, code.co_firstlineno, name)
+        profiler.originals.append((cls, methodName, function))
+        setattr(cls, methodName, profiledMethod(profiler, name, function))
+
+    activeProfiler = profiler
+    return profiler
+
+def disableProfiling():
+    "Restore the unwrapped methods. Returns the Profiler that was in use."
+    global activeProfiler
+    profiler = activeProfiler
+    if profiler:
+        for (cls, methodName, function) in profiler.originals:
+            setattr(cls, methodName, function)
+        activeProfiler = None
+    return profiler
+
+if os.environ.get('SUDOKU_PROFILE'):
+    enableProfiling().writeAtExit(os.environ['SUDOKU_PROFILE'])
+
+
+# Batch solving from the command line:
+#   sudoku.py solve [options] FILE|DIRECTORY|GLOB ...
+# prints one JSON object per puzzle as each one finishes.
+
+STATUS_SOLVED     = 'solved'
+STATUS_MULTIPLE   = 'multiple'
+STATUS_UNSOLVABLE = 'unsolvable'
+STATUS_INVALID    = 'invalid'
+STATUS_ERROR      = 'error'
+
+def findPuzzleFiles(paths, extension = '.sku'):
+    "Expand files, directories (recursively) and glob patterns."
+    return list(iterPuzzleFiles(paths, extension))
+
+def iterPuzzleFiles(paths, extension = '.sku'):
+    "findPuzzleFiles as a generator, walking directories as it goes."
+    for path in paths:
+        if os.path.isdir(path):
+            for (dirpath, dirnames, filenames) in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    if filename.endswith(extension):
+                        yield os.path.join(dirpath, filename)
+        elif glob.has_magic(path):
+            for filename in sorted(glob.glob(path)):
+                yield filename
+        else:
+            yield path
+
+def iterPuzzles(paths, extension = '.sku'):
+    """Yield (filename, board) for every puzzle in the given files,
+    directories and glob patterns, reading one puzzle at a time."""
+    for filename in iterPuzzleFiles(paths, extension):
+        infile = file(filename)
+        try:
+            for board in iterSudoku(infile):
+                yield (filename, board)
+        finally:
+            infile.close()
+
+def solveBoard(board, result, maxCount, method, showSolution, rate,
+               withStats = False):
+    "Fill in a batch result dict for a board."
+    if not board.isValid():
+        result['status'] = STATUS_INVALID
+        result['solutions'] = 0
+        return
+    if withStats:
+        stats = SolveStats()
+    else:
+        stats = None
+    solutions = board.solve(maxCount = maxCount, method = method,
+                            stats = stats)
+    if stats:
+        result['stats'] = stats.asDict()
+    result['solutions'] = len(solutions)
+    if not solutions:
+        result['status'] = STATUS_UNSOLVABLE
+    elif len(solutions) == 1:
+        result['status'] = STATUS_SOLVED
+    else:
+        result['status'] = STATUS_MULTIPLE
+    if showSolution and solutions:
+        if 'line' in result:
+            result['solution'] = solutions[0].toLine()
+        else:
+            result['solution'] = str(solutions[0])
+    if rate and len(solutions) == 1:
+        result['difficulty'] = board.difficultyString(3)
+
+def solveFile(task):
+    """Solve the puzzles from one source for batchSolve, returning a list
+    of result dicts. Runs in a worker process. The source is a file name,
+    or a (file name, line number, line) tuple for a puzzle in the one-line
+    format. Every puzzle in a file is solved; if there is more than one,
+    each result gives its position in the file as 'puzzle', from 1."""
+    (source, maxCount, method, showSolution, rate, withStats) = task
+    if isinstance(source, tuple):
+        (filename, number, line) = source
+        result = {'file': filename, 'line': number}
+        start = time.time()
+        try:
+            solveBoard(boardFromLine(line), result, maxCount, method,
+                       showSolution, rate, withStats)
+        except Exception, error:
+            result['status'] = STATUS_ERROR
+            result['error'] = str(error)
+        result['time'] = round(time.time() - start, 6)
+        return [result]
+
+    results = []
+    start = time.time()
+    try:
+        infile = file(source)
+        try:
+            for board in iterSudoku(infile):
+                result = {'file': source, 'puzzle': len(results) + 1}
+                solveBoard(board, result, maxCount, method, showSolution,
+                           rate, withStats)
+                result['time'] = round(time.time() - start, 6)
+                results.append(result)
+                start = time.time()
+        finally:
+            infile.close()
+        if not results:
+            raise ValueError('No puzzle in %s' % source)
+    except Exception, error:
+        results.append({'file': source, 'puzzle': len(results) + 1,
+                        'status': STATUS_ERROR, 'error': str(error),
+                        'time': round(time.time() - start, 6)})
+    if len(results) == 1:
+        del results[0]['puzzle']
+    return results
+
+def iterLineSources(filenames):
+    """(file name, line number, line) for each puzzle line in the given
+    files ('-' for standard input), for batchSolve."""
+    for filename in filenames:
+        if filename == '-':
+            infile = sys.stdin
+        else:
+            infile = file(filename)
+        try:
+            number = 0
+            for line in infile:
+                number += 1
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    yield (filename, number, line)
+        finally:
+            if infile is not sys.stdin:
+                infile.close()
+
+def batchSolve(files, workers = None, chunkSize = 1, maxCount = 2,
+               method = SOLVE_DLX, showSolution = False, rate = False,
+               withStats = False):
+    """Solve puzzles across a pool of worker processes, yielding a result
+    dict for each as it completes (not in input order). Files holding
+    several puzzles give a result for each (see solveFile). files may also
+    hold (file name, line number, line) tuples, as from iterLineSources.
+    If rate is set, uniquely solvable puzzles are given a difficulty; with
+    withStats, results include the solver's SolveStats as a dict."""
+    tasks = ((source, maxCount, method, showSolution, rate, withStats)
+             for source in files)
+    if workers == 1:
+        for task in tasks:
+            for result in solveFile(task):
+                yield result
+        return
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        for results in pool.imap_unordered(solveFile, tasks, chunkSize):
+            for result in results:
+                yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def solveCommand(args):
+    parser = optparse.OptionParser(
+        usage = '%prog solve [options] FILE|DIRECTORY|GLOB ...')
+    parser.add_option('-j', '--workers', type = 'int', default = None,
+                      help = 'worker processes (default: one per CPU)')
+    parser.add_option('-c', '--chunk-size', type = 'int', default = 1,
+                      help = 'puzzles handed to a worker at a time')
+    parser.add_option('-n', '--max-count', type = 'int', default = 2,
+                      help = 'stop counting solutions at this many')
+    parser.add_option('-m', '--method', default = SOLVE_DLX,
+                      choices = [SOLVE_BACKTRACK, SOLVE_DLX, SOLVE_PROPAGATE],
+                      help = 'solver to use (default: %default)')
+    parser.add_option('-s', '--show-solution', action = 'store_true',
+                      default = False, help = 'include the first solution')
+    parser.add_option('-r', '--rate', action = 'store_true', default = False,
+                      help = 'include the difficulty of each solvable puzzle')
+    parser.add_option('--stats', action = 'store_true', default = False,
+                      help = 'include search counters for each puzzle')
+    parser.add_option('-l', '--lines', action = 'store_true', default = False,
+                      help = 'read one puzzle per line from each FILE '
+                             '(- for standard input)')
+    (options, paths) = parser.parse_args(args)
+    if not paths:
+        parser.error('no puzzles given')
+
+    if options.lines:
+        files = iterLineSources(paths)
+    else:
+        files = findPuzzleFiles(paths)
+    failed = 0
+    for result in batchSolve(files, options.workers, options.chunk_size,
+                             options.max_count, options.method,
+                             options.show_solution, options.rate,
+                             options.stats):
+        if result['status'] != STATUS_SOLVED:
+            failed += 1
+        print json.dumps(result, sort_keys = True)
+        sys.stdout.flush()
+
+    return failed and 1 or 0
+
+
+# Parallel puzzle generation from the command line:
+#   sudoku.py generate [options] DIRECTORY
+# writes puzzles as they are found and prints one JSON object for each.
+
+DIFFICULTY_NAMES = [string for (minDiff, string) in DIFFICULTY_STR]
+
+# Default limit on generatePuzzles attempts, per puzzle wanted.
+GENERATE_ATTEMPTS = 1000
+
+def generateAttempt(task):
+    """Make one random puzzle for generatePuzzles. Runs in a worker
+    process; returns the seed, difficulty rating and a snapshot's values
+    and presets (or None if the attempt was abandoned)."""
+    (seed, size, maxBranch, symmetrical, hatchOnly) = task
+    board = randomPuzzle(size, maxBranch, symmetrical, hatchOnly, seed = seed)
+    if not board:
+        return (seed, None, None, None)
+    state = board.snapshot()
+    return (seed, board.difficultyString(3), state.values.tolist(), state.presets)
+
+def generatePuzzles(count, size = (3, 3), maxBranch = 0, symmetrical = True,
+                    hatchOnly = True, difficulties = None, workers = None,
+                    seed = None, maxAttempts = None):
+    """Run independent randomPuzzle attempts across a pool of worker
+    processes, seeded seed, seed + 1, ... and yield (seed, rating, board)
+    for each puzzle whose difficultyString is in difficulties (any, if not
+    given) until count have been found. Duplicate puzzles are skipped.
+    Results are taken in seed order, so the same seed always yields the
+    same puzzles. Raises RuntimeError after maxAttempts attempts (by
+    default GENERATE_ATTEMPTS per puzzle wanted)."""
+    if seed == None:
+        seed = random.randrange(1 << 31)
+    if workers == None:
+        workers = multiprocessing.cpu_count()
+    if maxAttempts == None:
+        maxAttempts = count * GENERATE_ATTEMPTS
+
+    geometry = getGeometry(size, (size[1], size[0]))
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+    else:
+        pool = None
+
+    found = 0
+    attempts = 0
+    seen = {}
+    try:
+        while found < count:
+            if attempts >= maxAttempts:
+                raise RuntimeError('Gave up after %d attempts, with %d of %d '
+                                   'puzzles found' % (attempts, found, count))
+            # Keep each worker busy with a few attempts per round.
+            tasks = [(seed + n, size, maxBranch, symmetrical, hatchOnly)
+                     for n in range(min(workers * 4, maxAttempts - attempts))]
+            seed += len(tasks)
+            attempts += len(tasks)
+            if pool:
+                results = pool.imap(generateAttempt, tasks)
+            else:
+                results = (generateAttempt(task) for task in tasks)
+
+            for (taskSeed, rating, values, presets) in results:
+                if rating == None or found >= count:
+                    continue
+                if difficulties and rating not in difficulties:
+                    continue
+                board = BoardState(geometry, array('B', values), presets).board()
+                if board.stateHash(True) in seen:
+                    continue
+                seen[board.stateHash(True)] = True
+                found += 1
+                board.seed = taskSeed
+                yield (taskSeed, rating, board)
+        if pool:
+            pool.close()
+    except:
+        if pool:
+            pool.terminate()
+        raise
+    finally:
+        if pool:
+            pool.join()
+
+def generateCommand(args):
+    parser = optparse.OptionParser(
+        usage = '%prog generate [options] DIRECTORY')
+    parser.add_option('-n', '--count', type = 'int', default = 10,
+                      help = 'number of puzzles to write (default: %default)')
+    parser.add_option('--size', default = '3x3',
+                      help = 'region width x height (default: %default)')
+    parser.add_option('-b', '--max-branch', type = 'int', default = 0,
+                      help = 'maximum look-ahead (default: %default)')
+    parser.add_option('--asymmetric', action = 'store_true', default = False,
+                      help = 'do not make puzzles symmetrical')
+    parser.add_option('--hatch-only', action = 'store_true', default = False,
+                      help = 'only allow cross-hatching to solve')
+    parser.add_option('-d', '--difficulty', action = 'append',
+                      choices = DIFFICULTY_NAMES,
+                      help = 'only keep puzzles rated this (repeatable)')
+    parser.add_option('-j', '--workers', type = 'int', default = None,
+                      help = 'worker processes (default: one per CPU)')
+    parser.add_option('--seed', type = 'int', default = None,
+                      help = 'seed for the first attempt')
+    parser.add_option('--max-attempts', type = 'int', default = None,
+                      help = 'give up after this many attempts (default: '
+                             '%d per puzzle)' % GENERATE_ATTEMPTS)
+    (options, args) = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error('expected one output directory')
+
+    sizeMatch = re.match('^([0-9]+)x([0-9]+)$', options.size)
+    if not sizeMatch:
+        parser.error('size should look like 3x3')
+    size = (int(sizeMatch.group(1)), int(sizeMatch.group(2)))
+
+    directory = args[0]
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    number = 0
+    puzzles = generatePuzzles(options.count, size, options.max_branch,
+                              not options.asymmetric, options.hatch_only,
+                              options.difficulty, options.workers,
+                              options.seed, options.max_attempts)
+    try:
+        for (seed, rating, board) in puzzles:
+            while True:
+                number += 1
+                filename = os.path.join(directory, 'puzzle-%dx%d-%02d.sku' %
+                                        (size[0], size[1], number))
+                if not os.path.exists(filename):
+                    break
+            writeSudoku(board, filename)
+            print json.dumps({'file': filename, 'seed': seed,
+                              'difficulty': rating},
+                             sort_keys = True)
+            sys.stdout.flush()
+    except RuntimeError, e:
+        print >> sys.stderr, e
+        return 1
+
+    return 0
+
+
+# Binary puzzle archives: an 8-byte header (ARCHIVE_MAGIC, a version byte,
+# the region width and height and a pad byte) followed by one fixed-width
+# record per puzzle: a byte per cell holding its value (0 for empty), then
+# the preset bitmap, least significant byte first. Seeds are not kept.
+
+ARCHIVE_MAGIC = 'SKUA'
+ARCHIVE_VERSION = 1
+archiveHeader = struct.Struct('<4sBBBx')
+
+def archiveRecordSize(geometry):
+    return geometry.cellCount + (geometry.cellCount + 7) / 8
+
+def packState(state):
+    "A BoardState as an archive record."
+    bitmapBytes = (state.geometry.cellCount + 7) / 8
+    bitmap = binascii.unhexlify('%0*x' % (bitmapBytes * 2, state.presets))
+    return state.values.tostring() + bitmap[::-1]
+
+def unpackState(geometry, record):
+    "The BoardState held in an archive record."
+    values = array('B', record[:geometry.cellCount])
+    presets = int(binascii.hexlify(record[geometry.cellCount:][::-1]), 16)
+    return BoardState(geometry, values, presets)
+
+def writeArchive(filename, boards, regionSize = None):
+    """Write boards (any iterable of SudokuBoards or BoardStates, all the
+    same shape) to a binary archive. regionSize is needed only if boards
+    may be empty. The archive is written under a temporary name and only
+    renamed into place once complete. Returns the number written."""
+    boards = iter(boards)
+    geometry = None
+    first = None
+    for first in boards:
+        geometry = first.geometry
+        break
+    if geometry == None:
+        if regionSize == None:
+            raise ValueError('No boards and no regionSize for the archive')
+        geometry = getGeometry(regionSize, (regionSize[1], regionSize[0]))
+
+    tempName = filename + '.tmp'
+    out = file(tempName, 'wb')
+    try:
+        out.write(archiveHeader.pack(ARCHIVE_MAGIC, ARCHIVE_VERSION,
+                                     geometry.regionSize[0],
+                                     geometry.regionSize[1]))
+        count = 0
+        while first != None:
+            if first.geometry is not geometry:
+                raise ValueError('Boards must all be the same shape')
+            if isinstance(first, BoardState):
+                out.write(packState(first))
+            else:
+                out.write(packState(first.snapshot()))
+            count += 1
+            first = next(boards, None)
+        out.close()
+        os.rename(tempName, filename)
+    except:
+        out.close()
+        os.remove(tempName)
+        raise
+    return count
+
+class PuzzleArchive:
+    """Read-only, memory-mapped access to a binary archive. Puzzles are
+    fetched by number in constant time: archive[n] is a SudokuBoard and
+    archive.state(n) a BoardState."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = file(filename, 'rb')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+        except:
+            self.file.close()
+            raise
+
+        if len(self.map) < archiveHeader.size:
+            self.close()
+            raise ValueError('%s is not a puzzle archive' % filename)
+        (magic, version, width, height) = archiveHeader.unpack(
+            self.map[:archiveHeader.size])
+        if magic != ARCHIVE_MAGIC or version != ARCHIVE_VERSION:
+            self.close()
+            raise ValueError('%s is not a puzzle archive' % filename)
+
+        self.geometry = getGeometry((width, height), (height, width))
+        self.recordSize = archiveRecordSize(self.geometry)
+        (self.count, extra) = divmod(len(self.map) - archiveHeader.size,
+                                     self.recordSize)
+        if extra:
+            self.close()
+            raise ValueError('%s is truncated' % filename)
+
+    def close(self):
+        if self.map != None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+    def __len__(self):
+        return self.count
+
+    def state(self, n):
+        if n < 0:
+            n += self.count
+        if not 0 <= n < self.count:
+            raise IndexError('Puzzle %d is out of range' % n)
+        start = archiveHeader.size + n * self.recordSize
+        return unpackState(self.geometry, self.map[start:start + self.recordSize])
+
+    def __getitem__(self, n):
+        return self.state(n).board()
+
+    def __iter__(self):
+        for n in range(self.count):
+            yield self[n]
+
+def packCommand(args):
+    parser = optparse.OptionParser(
+        usage = '%prog pack [options] ARCHIVE FILE|DIRECTORY|GLOB ...')
+    (options, paths) = parser.parse_args(args)
+    if len(paths) < 2:
+        parser.error('need an archive and some puzzles')
+
+    boards = (board for (filename, board) in iterPuzzles(paths[1:]))
+    try:
+        count = writeArchive(paths[0], boards)
+    except ValueError, e:
+        parser.error(str(e))
+    print json.dumps({'file': paths[0], 'puzzles': count}, sort_keys = True)
+    return 0
+
+def unpackCommand(args):
+    parser = optparse.OptionParser(
+        usage = '%prog unpack [options] ARCHIVE DIRECTORY')
+    (options, paths) = parser.parse_args(args)
+    if len(paths) != 2:
+        parser.error('need an archive and a directory')
+
+    (archiveName, directory) = paths
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    archive = PuzzleArchive(archiveName)
+    try:
+        (width, height) = archive.geometry.regionSize
+        for n in range(len(archive)):
+            writeSudoku(archive[n], os.path.join(directory,
+                'puzzle-%dx%d-%02d.sku' % (width, height, n + 1)))
+        print json.dumps({'directory': directory, 'puzzles': len(archive)},
+                         sort_keys = True)
+    finally:
+        archive.close()
+    return 0
+
+
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['solve']:
+        sys.exit(solveCommand(sys.argv[2:]))
+    elif sys.argv[1:2] == ['generate']:
+        sys.exit(generateCommand(sys.argv[2:]))
+    elif sys.argv[1:2] == ['pack']:
+        sys.exit(packCommand(sys.argv[2:]))
+    elif sys.argv[1:2] == ['unpack']:
+        sys.exit(unpackCommand(sys.argv[2:]))
+
     for filename in sys.argv[1:]:
         print filename
         sudoku = readSudoku(filename)
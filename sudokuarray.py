@@ -0,0 +1,276 @@
+# sudokuarray.py - NumPy batch solving for many boards of the same
+# shape at once.
+#
+# Boards are held as an (N, cells) uint8 array of values (0 for empty),
+# with cells numbered as in the BoardGeometry.
+
+import sys
+import json
+import optparse
+
+import numpy
+
+from sudoku import *
+
+STATUS_VALID = 'valid'
+
+def boardsToArray(boards):
+    "Pack boards (all the same shape) into an (N, cells) array."
+    geometry = None
+    rows = []
+    for board in boards:
+        if geometry == None:
+            geometry = board.geometry
+        elif board.geometry is not geometry:
+            raise ValueError('Boards must all be the same shape')
+        rows.append(numpy.frombuffer(board.cellValues.tostring(), numpy.uint8))
+    if not rows:
+        return numpy.zeros((0, 0), numpy.uint8)
+    return numpy.vstack(rows)
+
+def arrayToBoards(values, geometry, presets = None):
+    """Unpack an (N, cells) array into SudokuBoards. Non-empty cells are
+    marked preset unless a presets array of the same shape is given."""
+    boards = []
+    for n in range(len(values)):
+        row = values[n]
+        if presets is None:
+            mask = row != 0
+        else:
+            mask = (presets[n] != 0) & (row != 0)
+        bitmap = 0
+        for i in numpy.nonzero(mask)[0]:
+            bitmap |= 1 << int(i)
+        state = BoardState(geometry, array('B', row.astype(numpy.uint8).tostring()), bitmap)
+        boards.append(state.board())
+    return boards
+
+def unitValueCounts(values, geometry):
+    """How many times each value appears in each unit, as an (N, units,
+    values + 1) array. Column 0 counts empty cells."""
+    units = numpy.array(geometry.units)
+    onehot = values[:, :, None] == numpy.arange(geometry.values + 1, dtype = numpy.uint8)
+    return onehot[:, units, :].sum(2)
+
+def validArray(values, geometry):
+    "Boolean array: which boards have no value repeated in any unit."
+    counts = unitValueCounts(values, geometry)[:, :, 1:]
+    return ~(counts > 1).any(2).any(1)
+
+def findConflicts(values, geometry):
+    """The first repeated value in each board, as two arrays of length N:
+    the unit it repeats in (-1 for valid boards) and the value (0)."""
+    repeated = (unitValueCounts(values, geometry)[:, :, 1:] > 1)
+    repeated = repeated.reshape(len(values), -1)
+    first = repeated.argmax(1)
+    bad = repeated.any(1)
+    units = numpy.where(bad, first // geometry.values, -1)
+    repeats = numpy.where(bad, first % geometry.values + 1, 0)
+    return (units, repeats)
+
+def unitName(geometry, unit):
+    "Describe a unit, e.g. 'row 3'. Units are numbered from 0 by kind."
+    (width, height) = geometry.size
+    if unit < width:
+        return 'column %d' % unit
+    elif unit < width + height:
+        return 'row %d' % (unit - width)
+    else:
+        return 'region %d' % (unit - width - height)
+
+def readArrays(filenames):
+    """Read every puzzle in the given files into one (N, cells) array per
+    board shape. Returns a list of (geometry, sources, values) and a list
+    of (source, error message) for puzzles that could not be read. A
+    source is (filename, position of the puzzle in the file from 1), with
+    None for the position if the file holds only one puzzle."""
+    groups = {}
+    order = []
+    errors = []
+    for filename in filenames:
+        boards = []
+        error = None
+        try:
+            infile = file(filename)
+            try:
+                for board in iterSudoku(infile):
+                    boards.append(board)
+            finally:
+                infile.close()
+            if not boards:
+                raise ValueError('No puzzle in %s' % filename)
+        except Exception, e:
+            error = str(e)
+
+        # Positions are only given for files with more than one result.
+        if error == None and len(boards) == 1:
+            numbers = [None]
+        else:
+            numbers = range(1, len(boards) + 1)
+        if error != None:
+            errors.append(((filename, boards and len(boards) + 1 or None),
+                           error))
+
+        for (number, board) in zip(numbers, boards):
+            if board.geometry not in groups:
+                groups[board.geometry] = ([], [])
+                order.append(board.geometry)
+            (sources, rows) = groups[board.geometry]
+            sources.append((filename, number))
+            rows.append(numpy.frombuffer(board.cellValues.tostring(),
+                                         numpy.uint8))
+    return ([(geometry, groups[geometry][0], numpy.vstack(groups[geometry][1]))
+             for geometry in order], errors)
+
+def sourceResult(source):
+    "The start of a result dict for a (filename, position) source."
+    (filename, number) = source
+    result = {'file': filename}
+    if number != None:
+        result['puzzle'] = number
+    return result
+
+def validateFiles(filenames):
+    """Check puzzle files for repeated values, a vectorised pass per board
+    shape. Yields a result dict per puzzle, as for sudoku.batchSolve; an
+    invalid puzzle's result names the unit, the repeated value and the
+    cells holding it."""
+    (groups, errors) = readArrays(filenames)
+    for (source, message) in errors:
+        result = sourceResult(source)
+        result['status'] = STATUS_ERROR
+        result['error'] = message
+        yield result
+
+    for (geometry, sources, values) in groups:
+        (units, repeats) = findConflicts(values, geometry)
+        for n in range(len(sources)):
+            result = sourceResult(sources[n])
+            unit = units[n]
+            if unit < 0:
+                result['status'] = STATUS_VALID
+            else:
+                cells = [i for i in geometry.units[unit]
+                         if values[n, i] == repeats[n]]
+                result['status'] = STATUS_INVALID
+                result['unit'] = unitName(geometry, unit)
+                result['value'] = int(repeats[n])
+                result['cells'] = [geometry.coords[i] for i in cells]
+            yield result
+
+def candidateMasks(values, geometry):
+    """Candidate bitmask (as in sudoku.valueBit) for every cell of every
+    board, as an (N, cells) int64 array; 0 for filled cells."""
+    units = numpy.array(geometry.units)
+    cellUnits = numpy.array(geometry.cellUnits)
+
+    wide = values.astype(numpy.int64)
+    bits = numpy.left_shift(1, numpy.maximum(wide, 1) - 1)
+    bits[wide == 0] = 0
+
+    used = numpy.bitwise_or.reduce(bits[:, units], axis = 2)
+    cellUsed = numpy.bitwise_or.reduce(used[:, cellUnits], axis = 2)
+    candidates = geometry.allValues & ~cellUsed
+    candidates[wide != 0] = 0
+    return candidates
+
+def propagateSingles(values, geometry):
+    """Fill naked and hidden singles in every board, in vectorised passes,
+    until no board changes. values is updated in place. Returns a boolean
+    array of boards found to be contradictory."""
+    units = numpy.array(geometry.units)
+    shifts = numpy.arange(geometry.values, dtype = numpy.int64)
+    valueNumbers = numpy.arange(1, geometry.values + 1, dtype = numpy.uint8)
+
+    dead = ~validArray(values, geometry)
+    active = ~dead
+
+    while active.any():
+        index = numpy.nonzero(active)[0]
+        current = values[index]
+        candidates = candidateMasks(current, geometry)
+        empty = current == 0
+
+        # has[n, cell, v] is set if the cell could hold value v + 1.
+        has = ((candidates[:, :, None] >> shifts) & 1).astype(numpy.uint8)
+        stuck = (empty & (candidates == 0)).any(1)
+
+        # Naked singles: cells with exactly one candidate.
+        naked = empty & (has.sum(2) == 1)
+        nakedValue = valueNumbers[has.argmax(2)]
+
+        # Hidden singles: values with exactly one place in a unit.
+        unitHas = has[:, units, :]
+        places = unitHas.sum(2)
+        missing = unitValueCounts(current, geometry)[:, :, 1:] == 0
+        stuck |= (missing & (places == 0)).any(2).any(1)
+        hidden = missing & (places == 1)
+        where = unitHas.argmax(2)
+
+        updated = current.copy()
+        updated[naked] = nakedValue[naked]
+        (n, u, v) = numpy.nonzero(hidden)
+        updated[n, units[u, where[n, u, v]]] = valueNumbers[v]
+
+        changed = (updated != current).any(1)
+        stuck |= ~validArray(updated, geometry)
+        values[index] = updated
+
+        dead[index] |= stuck
+        active[index] = changed & ~stuck
+
+    return dead
+
+def solveArray(values, geometry, maxCount = 2, method = SOLVE_DLX):
+    """Solve N boards of one shape. Singles are filled for all boards at
+    once; only boards left unfinished fall back to SudokuBoard.solve.
+
+    Returns (solutions, counts): an (N, cells) array holding the first
+    solution found for each board (all zero if there is none), and the
+    number of solutions found, stopping at maxCount."""
+    solutions = numpy.array(values, numpy.uint8)
+    dead = propagateSingles(solutions, geometry)
+
+    counts = numpy.zeros(len(solutions), numpy.int32)
+    solved = (solutions != 0).all(1) & ~dead
+    counts[solved] = 1
+    solutions[dead] = 0
+
+    # Every cell filled by singles was forced, so boards finished that
+    # way have exactly one solution. The rest need a search.
+    for n in numpy.nonzero(~solved & ~dead)[0]:
+        board = arrayToBoards(solutions[n:n + 1], geometry)[0]
+        found = board.solve(maxCount = maxCount, method = method)
+        counts[n] = len(found)
+        if found:
+            solutions[n] = numpy.frombuffer(found[0].cellValues.tostring(),
+                                            numpy.uint8)
+        else:
+            solutions[n] = 0
+
+    return (solutions, counts)
+
+def solveBoards(boards, maxCount = 2, method = SOLVE_DLX):
+    "solveArray for a list of SudokuBoards of one shape."
+    if not boards:
+        return (numpy.zeros((0, 0), numpy.uint8), numpy.zeros(0, numpy.int32))
+    return solveArray(boardsToArray(boards), boards[0].geometry,
+                      maxCount, method)
+
+
+# Validate a batch of puzzles from the command line:
+#   sudokuarray.py FILE|DIRECTORY|GLOB ...
+# prints one JSON object per puzzle; exits 1 if any is invalid or unreadable.
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage = '%prog FILE|DIRECTORY|GLOB ...')
+    (options, paths) = parser.parse_args()
+    if not paths:
+        parser.error('no puzzles given')
+
+    failed = 0
+    for result in validateFiles(findPuzzleFiles(paths)):
+        if result['status'] != STATUS_VALID:
+            failed += 1
+        print json.dumps(result, sort_keys = True)
+    sys.exit(failed and 1 or 0)
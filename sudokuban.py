@@ -4,8 +4,8 @@
 # sudokuban.py - GUI for SudokuBan.
 #
 
-import os, sys, time
-import pygtk, gtk, pango
+import os, sys, time, threading, traceback, bisect
+import pygtk, gtk, gobject, pango
 
 from sudoku import *
 
@@ -23,6 +23,15 @@ KEY_ARROWS = (KEY_LEFT, KEY_UP, KEY_RIGHT, KEY_DOWN)
 KEY_BACKSPACE = 65288
 KEY_DELETE    = 65535
 
+# Board views. The widget view has a widget per cell; the drawn view draws
+# the whole board in one widget, which is much quicker to create and lay
+# out for big boards. Auto uses the drawn view for boards with more than
+# DRAWN_VIEW_CELLS cells.
+VIEW_AUTO    = 'auto'
+VIEW_WIDGETS = 'widgets'
+VIEW_DRAWN   = 'drawn'
+DRAWN_VIEW_CELLS = 256
+
 # Tooltips. TODO: i18n.
 tipNew = 'Create a new empty or random puzzle.'
 
@@ -74,6 +83,8 @@ tipNewCrossHatchOnly = 'Make the puzzle solvable using only "cross-hatching" - l
 
 tipNewLookAhead = 'The maximum number of steps in solving the puzzle that require you to "look ahead" to determine some numbers. Values above zero tend to make the puzzle much more difficult.'
 
+tipNewSeed = 'Seed for the random puzzle. The same seed and options always make the same puzzle. Leave blank for a new random puzzle; the seed used is saved with the puzzle.'
+
 class Settings:
     def __init__(self, filename = None):
         self.filename = filename
@@ -91,6 +102,8 @@ class Settings:
         self.fontPreset = pango.FontDescription('sans bold 24')
         self.fontUnset =  pango.FontDescription('sans 24')
 
+        self.boardView = VIEW_AUTO
+
         # Load from file
         self.load()
 
@@ -121,6 +134,11 @@ class Settings:
                     
                     self.highlightShade[(row, col, reg)] = shade
 
+    def useDrawnView(self, board):
+        if self.boardView == VIEW_AUTO:
+            return board.cellCount > DRAWN_VIEW_CELLS
+        return self.boardView == VIEW_DRAWN
+
     def colourToStr(self, colour):
         return '#%04X%04X%04X' % (colour.red, colour.green, colour.blue)
 
@@ -174,6 +192,10 @@ class Settings:
                             self.fontPreset = value
                         elif attrib == 'font.unset':
                             self.fontUnset = value
+
+                    elif attrib == 'board.view':
+                        if value in (VIEW_AUTO, VIEW_WIDGETS, VIEW_DRAWN):
+                            self.boardView = value
                 except:
                     continue
             
@@ -198,6 +220,8 @@ class Settings:
             
             print >> out, 'font.preset =', self.fontPreset.to_string()
             print >> out, 'font.unset =', self.fontUnset.to_string()
+
+            print >> out, 'board.view =', self.boardView
             
             out.close()
 
@@ -217,6 +241,10 @@ class SudokuAction:
     def inverse(self):
         return None
 
+    def entries(self):
+        "The entries whose cells this action changes."
+        return []
+
     def __repr__(self):
         return 'Action'
 
@@ -251,6 +279,9 @@ class SetEntryAction(SudokuAction):
                               self.select, self.entry.isPreset(),
                               self.update, self.title)
 
+    def entries(self):
+        return [self.entry]
+
     def execute(self):
         self.entry.setValue(self.value, self.preset)
         if self.select:
@@ -275,68 +306,85 @@ class CompoundAction(SudokuAction):
             inverse_actions.append(self.actions[i].inverse())
         return CompoundAction(self.gui, inverse_actions, self.title)
 
+    def entries(self):
+        entries = []
+        for action in self.actions:
+            entries.extend(action.entries())
+        return entries
+
     def execute(self):
         for action in self.actions:
             action.execute()
         if self.update:
-            self.gui.updateAll()
+            self.gui.updateEntries(self.entries())
 
     def __repr__(self):
         return self.title
 
 
-class BoardEntry(gtk.EventBox):
+class BoardAction(SudokuAction):
+    """Set many cells in one go, e.g. to fill in a solution. changes is a
+    list of (index, value, preset) for the cells that change only, and
+    the board is updated with a single SudokuBoard.setValues."""
 
-    def __init__(self, cell, gui):
-        gtk.EventBox.__init__(self)
+    def __init__(self, gui, changes, title):
+        SudokuAction.__init__(self, gui)
+        self.changes = changes
+        self.title = title
 
-        self.cell = cell
-        self.gui = gui
+    def inverse(self):
+        board = self.gui.board
+        changes = [(i, board.cellValues[i], (board.presets >> i) & 1)
+                   for (i, value, preset) in self.changes]
+        return BoardAction(self.gui, changes, self.title)
 
-        self.label = gtk.Label()
-        self.label.set_alignment(0.5, 0.5)
-        self.label.show()
-        self.add(self.label)
+    def entries(self):
+        return [self.gui.cellEntries[i] for (i, value, preset) in self.changes]
 
-        self.connect('button_press_event', gui.clickInCell, self.cell)
-        self.connect('popup_menu', gui.numberMenu, self.cell)
-        self.connect('size-request', self.setSizeRequest)
+    def execute(self):
+        if not self.changes:
+            return
+        gui = self.gui
+        gui.board.setValues(self.changes)
+        gui.boardChanged()
+        if gui.selection and gui.selection.cell.value:
+            gui.selectedValue = gui.selection.cell.value
+        gui.updateEntries(self.entries())
 
-        self.update()
+    def __repr__(self):
+        return self.title
 
-    def update(self):
+
+class CellEntry:
+    """What BoardEntry and DrawnEntry have in common: editing a cell, and
+    working out how it should look."""
+
+    def appearance(self):
+        "(text, background, font, colour, selected) for the cell."
         if self.cell.value:
-            self.label.set_text(str(self.cell.value))
+            text = str(self.cell.value)
         else:
-            self.label.set_text(' ')
+            text = ' '
 
-        if self.gui.scanHighlight and self.gui.selectedValue:
+        value = self.gui.highlightValue()
+        if value:
             shadeKey = (
-                self.cell.sets[0].isAvailable(self.gui.selectedValue),
-                self.cell.sets[1].isAvailable(self.gui.selectedValue),
-                self.cell.sets[2].isAvailable(self.gui.selectedValue)
+                self.cell.sets[0].isAvailable(value),
+                self.cell.sets[1].isAvailable(value),
+                self.cell.sets[2].isAvailable(value)
                 )
-            self.modify_bg(gtk.STATE_NORMAL, settings.highlightShade[shadeKey])
+            background = settings.highlightShade[shadeKey]
         else:
-            self.modify_bg(gtk.STATE_NORMAL, settings.colourBackground)
+            background = settings.colourBackground
 
         if self.cell.state == CELL_PRESET:
-            self.label.modify_font(settings.fontPreset)
-            self.label.modify_fg(gtk.STATE_NORMAL, settings.colourPreset)
+            font = settings.fontPreset
+            colour = settings.colourPreset
         else:
-            self.label.modify_font(settings.fontUnset)
-            self.label.modify_fg(gtk.STATE_NORMAL, settings.colourUnset)
-            
-        if self is self.gui.selection:
-            self.set_state(gtk.STATE_SELECTED)
-        else:
-            self.set_state(gtk.STATE_NORMAL)
+            font = settings.fontUnset
+            colour = settings.colourUnset
 
-    def setSizeRequest(self, widget, requisition):
-        if requisition.width < requisition.height:
-            self.set_size_request(requisition.height, requisition.height)
-        elif requisition.height < requisition.width:
-            self.set_size_request(requisition.width, requisition.width)
+        return (text, background, font, colour, self is self.gui.selection)
 
     def setValue(self, value, preset):
         if value == 0:
@@ -345,7 +393,7 @@ class BoardEntry(gtk.EventBox):
 
         if value != self.cell.value or \
            preset != (self.cell.state == CELL_PRESET):
-            self.gui.dirty = True
+            self.gui.boardChanged()
         
         if self.cell.value != value:
             self.cell.setValue(value)
@@ -363,6 +411,239 @@ class BoardEntry(gtk.EventBox):
     def isPreset(self):
         return self.cell.state == CELL_PRESET
 
+
+class BoardEntry(gtk.EventBox, CellEntry):
+
+    def __init__(self, cell, gui):
+        gtk.EventBox.__init__(self)
+
+        self.cell = cell
+        self.gui = gui
+
+        self.label = gtk.Label()
+        self.label.set_alignment(0.5, 0.5)
+        self.label.show()
+        self.add(self.label)
+
+        # What was last drawn, so that update only touches what changed.
+        # Settings changes replace the colour and font objects, so these
+        # are compared by identity.
+        self.shownText = None
+        self.shownBackground = None
+        self.shownFont = None
+        self.shownColour = None
+        self.shownState = None
+
+        self.connect('button_press_event', gui.clickInCell, self.cell)
+        self.connect('popup_menu', gui.numberMenu, self.cell)
+        self.connect('size-request', self.setSizeRequest)
+
+        self.update()
+
+    def update(self):
+        (text, background, font, colour, selected) = self.appearance()
+        if selected:
+            state = gtk.STATE_SELECTED
+        else:
+            state = gtk.STATE_NORMAL
+
+        if text != self.shownText:
+            self.label.set_text(text)
+            self.shownText = text
+        if background is not self.shownBackground:
+            self.modify_bg(gtk.STATE_NORMAL, background)
+            self.shownBackground = background
+        if font is not self.shownFont:
+            self.label.modify_font(font)
+            self.shownFont = font
+        if colour is not self.shownColour:
+            self.label.modify_fg(gtk.STATE_NORMAL, colour)
+            self.shownColour = colour
+        if state != self.shownState:
+            self.set_state(state)
+            self.shownState = state
+
+    def setSizeRequest(self, widget, requisition):
+        if requisition.width < requisition.height:
+            self.set_size_request(requisition.height, requisition.height)
+        elif requisition.height < requisition.width:
+            self.set_size_request(requisition.width, requisition.width)
+
+
+class DrawnEntry(CellEntry):
+    "A cell of a BoardView. It has no widget; the view draws it."
+
+    def __init__(self, cell, gui, view):
+        self.cell = cell
+        self.gui = gui
+        self.view = view
+        self.shown = None
+        self.update()
+
+    def update(self):
+        appearance = self.appearance()
+        if appearance != self.shown:
+            self.shown = appearance
+            self.view.queueCell(self)
+
+
+class BoardView(gtk.DrawingArea):
+    """The whole board drawn in a single widget, laid out like the widget
+    view: cells 1 pixel apart, regions 5 apart. It does its own
+    hit-testing; the window's key handler moves the selection as usual."""
+
+    cellSpacing = 1
+    regionSpacing = 5
+
+    def __init__(self, gui):
+        gtk.DrawingArea.__init__(self)
+
+        self.gui = gui
+        self.board = gui.board
+
+        # Text layouts by (text, font), and the left and top edges of each
+        # column and row, set when the view is allocated.
+        self.layouts = {}
+        self.cellSize = 0
+        self.columns = []
+        self.rows = []
+
+        self.set_flags(gtk.CAN_FOCUS)
+        self.add_events(gtk.gdk.BUTTON_PRESS_MASK)
+        self.connect('expose-event', self.expose)
+        self.connect('size-allocate', self.allocate)
+        self.connect('button-press-event', self.buttonPress)
+        self.connect('popup-menu', self.popupMenu)
+
+        self.entries = [DrawnEntry(self.board[coord], gui, self)
+                        for coord in self.board.geometry.coords]
+        self.measure()
+
+    def layout(self, text, font):
+        key = (text, font.to_string())
+        if key not in self.layouts:
+            layout = self.create_pango_layout(text)
+            layout.set_font_description(font)
+            self.layouts[key] = layout
+        return self.layouts[key]
+
+    def span(self, cells, regionCells, cellSize):
+        "Pixels across cells cells, in regions of regionCells."
+        regions = cells / regionCells
+        return cells * cellSize + (cells - regions) * self.cellSpacing + \
+               (regions - 1) * self.regionSpacing
+
+    def edges(self, cells, regionCells, cellSize, offset):
+        return [offset + i * cellSize +
+                (i - i / regionCells) * self.cellSpacing +
+                (i / regionCells) * self.regionSpacing
+                for i in range(cells)]
+
+    def measure(self):
+        "Request enough room for every value in either font."
+        cellSize = 1
+        for font in (settings.fontPreset, settings.fontUnset):
+            for value in range(1, self.board.values + 1):
+                (width, height) = self.layout(str(value), font).get_pixel_size()
+                cellSize = max(cellSize, width, height)
+
+        (width, height) = self.board.size
+        (regionWidth, regionHeight) = self.board.regionSize
+        self.set_size_request(self.span(width, regionWidth, cellSize),
+                              self.span(height, regionHeight, cellSize))
+
+    def allocate(self, widget, allocation):
+        (width, height) = self.board.size
+        (regionWidth, regionHeight) = self.board.regionSize
+        cellSize = min(
+            (allocation.width - self.span(width, regionWidth, 0)) / width,
+            (allocation.height - self.span(height, regionHeight, 0)) / height)
+        self.cellSize = max(cellSize, 1)
+
+        # Centre the board in any leftover space.
+        left = (allocation.width - self.span(width, regionWidth, self.cellSize)) / 2
+        top = (allocation.height - self.span(height, regionHeight, self.cellSize)) / 2
+        self.columns = self.edges(width, regionWidth, self.cellSize, left)
+        self.rows = self.edges(height, regionHeight, self.cellSize, top)
+
+    def refresh(self):
+        "Redraw everything, after a settings change."
+        self.measure()
+        self.queue_draw()
+
+    def queueCell(self, entry):
+        if self.cellSize:
+            (x, y) = entry.cell.coord
+            self.queue_draw_area(self.columns[x], self.rows[y],
+                                 self.cellSize, self.cellSize)
+
+    def index(self, edges, position):
+        "The column or row at position along edges, or None in a gap."
+        i = bisect.bisect_right(edges, position) - 1
+        if i >= 0 and position < edges[i] + self.cellSize:
+            return i
+        return None
+
+    def entryAt(self, x, y):
+        column = self.index(self.columns, x)
+        row = self.index(self.rows, y)
+        if column == None or row == None:
+            return None
+        return self.entries[row * self.board.size[0] + column]
+
+    def expose(self, widget, event):
+        area = event.area
+        gc = gtk.gdk.GC(self.window)
+        gc.set_rgb_fg_color(settings.colourBorder)
+        self.window.draw_rectangle(gc, True, area.x, area.y,
+                                   area.width, area.height)
+
+        # Only the cells the exposed area touches.
+        columns = [x for x in range(len(self.columns))
+                   if self.columns[x] < area.x + area.width and
+                      self.columns[x] + self.cellSize > area.x]
+        rows = [y for y in range(len(self.rows))
+                if self.rows[y] < area.y + area.height and
+                   self.rows[y] + self.cellSize > area.y]
+        for y in rows:
+            for x in columns:
+                self.drawCell(gc, self.entries[y * self.board.size[0] + x])
+        return True
+
+    def drawCell(self, gc, entry):
+        (text, background, font, colour, selected) = entry.shown
+        if selected:
+            background = self.style.bg[gtk.STATE_SELECTED]
+            colour = self.style.fg[gtk.STATE_SELECTED]
+
+        (x, y) = entry.cell.coord
+        left = self.columns[x]
+        top = self.rows[y]
+        gc.set_rgb_fg_color(background)
+        self.window.draw_rectangle(gc, True, left, top,
+                                   self.cellSize, self.cellSize)
+
+        if entry.cell.value:
+            layout = self.layout(text, font)
+            (width, height) = layout.get_pixel_size()
+            gc.set_rgb_fg_color(colour)
+            self.window.draw_layout(gc, left + (self.cellSize - width) / 2,
+                                    top + (self.cellSize - height) / 2, layout)
+
+    def buttonPress(self, widget, event):
+        entry = self.entryAt(event.x, event.y)
+        if entry == None:
+            return False
+        self.grab_focus()
+        return self.gui.clickInCell(entry, event, entry.cell)
+
+    def popupMenu(self, widget):
+        entry = self.gui.selection
+        if entry:
+            return self.gui.numberMenu(entry, entry.cell)
+        return False
+
+
 class SudokuGUI:
     def __init__(self, board = SudokuBoard(), filename = None, dirty = False):
         openWindows.append(self)
@@ -370,6 +651,7 @@ class SudokuGUI:
         self.scanHighlight = False
         self.selection = None
         self.selectedValue = 0
+        self.highlighted = 0
         self.exclude = False
         self.digitKeys = ''
         self.preset = False
@@ -393,6 +675,32 @@ class SudokuGUI:
 
         self.board = board
 
+        self.entries = []
+        self.cells = {}
+        self.cellEntries = [None] * self.board.cellCount
+
+        if settings.useDrawnView(self.board):
+            self.view = BoardView(self)
+            self.entries = self.view.entries
+            for entry in self.entries:
+                self.cells[entry.cell.coord] = entry
+                self.cellEntries[entry.cell.index] = entry
+            boardWidget = self.view
+        else:
+            self.view = None
+            self.createTable()
+            boardWidget = self.table
+
+        # Empty board starts off editing presets
+        if self.board.filled == 0:
+            self.actionGroup.get_action('Presets').set_active(True)
+
+        self.vbox.add(boardWidget)
+        boardWidget.show()
+        self.window.show()
+
+    def createTable(self):
+        "The widget view: a table of regions, each a table of BoardEntrys."
         regions = self.board.regionCount
         regionSize = self.board.regionSize
         
@@ -401,9 +709,6 @@ class SudokuGUI:
         self.table.set_col_spacings(5)
         self.window.modify_bg(gtk.STATE_NORMAL, settings.colourBorder)
 
-        self.entries = []
-        self.cells = {}
-
         for regionY in range(regions[1]):
             for regionX in range(regions[0]):
                 regionTable = gtk.Table(regionSize[1], regionSize[0], True)
@@ -422,6 +727,7 @@ class SudokuGUI:
                         entry = BoardEntry(cell, self)
                         self.entries.append(entry)
                         self.cells[cell.coord] = entry
+                        self.cellEntries[cell.index] = entry
                         
                         regionTable.attach(entry, x, x + 1, y, y + 1)
                         entry.show()
@@ -431,14 +737,6 @@ class SudokuGUI:
                                   regionY, regionY + 1)
                 regionTable.show()
 
-        # Empty board starts off editing presets
-        if self.board.filled == 0:
-            self.actionGroup.get_action('Presets').set_active(True)
-
-        self.vbox.add(self.table)
-        self.table.show()
-        self.window.show()
-
     def keyPress(self, widget, event):
         key = event.keyval
         if key >= 0 and key < 256:
@@ -650,16 +948,41 @@ class SudokuGUI:
 
         return True
 
-    def update(self, entry):
+    def highlightValue(self):
+        "The value scan highlighting is shown for, or 0 for none."
         if self.scanHighlight:
+            return self.selectedValue
+        return 0
+
+    def update(self, entry):
+        self.updateEntries([entry])
+
+    def updateEntries(self, entries):
+        """Repaint after the given entries' cells changed. With scan
+        highlighting on, only their peers' shades can change too. The
+        whole board is repainted if the highlighted value changed, or if
+        enough entries changed that it would be quicker."""
+        if self.highlightValue() != self.highlighted or \
+           len(entries) * 4 > len(self.entries):
             self.updateAll()
-        else:
+            return
+
+        dirty = {}
+        for entry in entries:
+            dirty[entry] = True
+            if self.highlighted:
+                for peer in self.board.geometry.peers[entry.cell.index]:
+                    dirty[self.cellEntries[peer]] = True
+        for entry in dirty:
             entry.update()
 
     def updateAll(self):
         self.window.modify_bg(gtk.STATE_NORMAL, settings.colourBorder)
+        self.highlighted = self.highlightValue()
         for entry in self.entries:
             entry.update()        
+        if self.view:
+            self.view.refresh()
 
     def setEntry(self, entry, value):
         if (not self.preset) and entry.isPreset():
@@ -714,20 +1037,17 @@ class SudokuGUI:
         dialog.show()
 
     def checkSolvable(self, widget = None):
-        progress = ProgressDialog('Check Solvable')
+        progress = ProgressDialog('Check Solvable', self.window)
         progress.setLabel('Checking for solutions...')
         progress.show()
-        progress.update()
 
-        solutions = self.board.solve(True, 2, progress = progress.pulse,
-                                     cancel = progress.cancelled)
+        board = self.board.copy()
+        def run(report, cancelled):
+            return board.solve(True, 2, progress = report, cancel = cancelled)
 
-        cancelled = progress.isCancelled
-        progress.destroy()
+        BackgroundTask(progress, run, self.showSolvable)
 
-        if cancelled:
-            return
-        
+    def showSolvable(self, solutions):
         if solutions == 1:
             dialog = gtk.MessageDialog(self.window, gtk.DIALOG_MODAL,
                                        gtk.MESSAGE_INFO, gtk.BUTTONS_OK)
@@ -747,20 +1067,17 @@ class SudokuGUI:
     def difficulty(self, widget = None):
         basePuzzle = self.board.copy(True)
         
-        progress = ProgressDialog('Difficulty')
+        progress = ProgressDialog('Difficulty', self.window)
         progress.setLabel('Estimating difficulty...')
         progress.show()
-        progress.update()
 
-        difficulty = basePuzzle.difficultyString(3, progress = progress.pulse,
-                                                 cancel = progress.cancelled)
+        def run(report, cancelled):
+            return basePuzzle.difficultyString(3, progress = report,
+                                               cancel = cancelled)
 
-        cancelled = progress.isCancelled
-        progress.destroy()
-
-        if cancelled:
-            return
+        BackgroundTask(progress, run, self.showDifficulty)
 
+    def showDifficulty(self, difficulty):
         dialog = gtk.MessageDialog(self.window, gtk.DIALOG_MODAL,
                                    gtk.MESSAGE_INFO, gtk.BUTTONS_OK)
         dialog.set_markup('Puzzle difficulty: ' + difficulty)        
@@ -769,35 +1086,37 @@ class SudokuGUI:
         dialog.show()
 
     def solve(self, action):
-        progress = ProgressDialog('Solve Puzzle')
+        progress = ProgressDialog('Solve Puzzle', self.window)
         progress.setLabel('Solving puzzle...')
         progress.show()
-        progress.update()
 
-        solutions = self.board.solve(maxCount = 1, progress = progress.pulse,
-                                     cancel = progress.cancelled)
+        board = self.board.copy()
+        def run(report, cancelled):
+            return board.solve(maxCount = 1, progress = report,
+                               cancel = cancelled)
 
-        cancelled = progress.isCancelled
-        progress.destroy()
+        BackgroundTask(progress, run, self.showSolution)
 
-        if cancelled:
-            return
-        
+    def showSolution(self, solutions):
         if solutions:
-            actions = []
-            for y in range(self.board.regionCount[1] * self.board.regionSize[1]):
-                for x in range(self.board.regionCount[0] * self.board.regionSize[0]):
-                    entry = self.cells[(x, y)]
-                    actions.append(SetEntryAction(self, entry,
-                                                  solutions[0][x, y].value,
-                                                  False, entry.isPreset(),
-                                                  False))
-
-            compound = CompoundAction(self, actions, 'Solve')
-            self.runAction(compound)
+            values = self.board.cellValues
+            solution = solutions[0].cellValues
+            changes = [(i, solution[i], (self.board.presets >> i) & 1)
+                       for i in range(self.board.cellCount)
+                       if solution[i] != values[i]]
+            self.runAction(BoardAction(self, changes, 'Solve'))
+
+    def boardChanged(self):
+        """Note an edit: the board needs saving, and no longer matches the
+        seed it was generated from, if any."""
+        self.dirty = True
+        self.board.seed = None
 
     def duplicate(self, widget):
-        gui = SudokuGUI(self.board.copy(), dirty = True)
+        board = self.board.copy()
+        # The copy is a new, unsaved puzzle: don't pass the seed on.
+        board.seed = None
+        gui = SudokuGUI(board, dirty = True)
 
     def newPuzzleDialog(self, widget):
         newPuzzleDialog(widget, self)
@@ -903,9 +1222,12 @@ class SudokuGUI:
 
 
 class ProgressDialog(gtk.Dialog):
-    def __init__(self, title = 'Progress'):
-        gtk.Dialog.__init__(self, title,
+    def __init__(self, title = 'Progress', parent = None):
+        gtk.Dialog.__init__(self, title, parent,
                             buttons = (gtk.STOCK_CANCEL, gtk.RESPONSE_CANCEL))
+        if parent:
+            # Keep the board from being edited behind a background task.
+            self.set_modal(True)
 
         self.isCancelled = False
 
@@ -936,11 +1258,20 @@ class ProgressDialog(gtk.Dialog):
             self.bar.set_fraction(fraction)
             self.update()
 
-    def pulse(self):
+    def pulse(self, monitor = None):
         if not self.isCancelled:
             self.bar.pulse()
             self.update()
 
+    def showSearch(self, nodes, fraction):
+        "Show a background task's progress, from the main loop."
+        if not self.isCancelled:
+            if fraction > 0.001:
+                self.bar.set_fraction(fraction)
+            else:
+                self.bar.pulse()
+            self.bar.set_text('%d positions searched' % nodes)
+
     def cancelled(self):
         return self.isCancelled
 
@@ -952,6 +1283,69 @@ class ProgressDialog(gtk.Dialog):
             gtk.main_iteration()
 
 
+class BackgroundTask:
+    """Run function(progress, cancelled) in a worker thread, so that the
+    GTK main loop keeps running. function should pass them on as the
+    progress and cancel callbacks of a search. The ProgressDialog is
+    pulsed from a timeout while it runs; when it is done, the dialog is
+    destroyed and, unless it was cancelled, finished(result) is called
+    from the main loop. Give function its own copy of the board to work
+    on."""
+
+    # Milliseconds between progress updates.
+    PULSE_INTERVAL = 100
+
+    def __init__(self, progress, function, finished):
+        self.progress = progress
+        self.function = function
+        self.finished = finished
+        self.nodes = 0
+        self.fraction = 0.0
+        self.shownNodes = 0
+        self.result = None
+        self.error = None
+
+        self.timer = gobject.timeout_add(self.PULSE_INTERVAL, self.poll)
+        self.thread = threading.Thread(target = self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def report(self, monitor):
+        "Progress callback, called by the search in the worker thread."
+        self.nodes = monitor.nodes
+        self.fraction = monitor.fraction
+
+    def run(self):
+        try:
+            self.result = self.function(self.report, self.progress.cancelled)
+        except:
+            self.error = traceback.format_exc()
+        gobject.idle_add(self.done)
+
+    def poll(self):
+        if self.nodes != self.shownNodes:
+            self.shownNodes = self.nodes
+            self.progress.showSearch(self.nodes, self.fraction)
+        return True
+
+    def done(self):
+        gobject.source_remove(self.timer)
+        cancelled = self.progress.isCancelled
+        parent = self.progress.get_transient_for()
+        self.progress.destroy()
+
+        if self.error:
+            print >> sys.stderr, self.error
+            dialog = gtk.MessageDialog(parent, gtk.DIALOG_MODAL,
+                                       gtk.MESSAGE_ERROR, gtk.BUTTONS_OK)
+            dialog.set_markup('An unknown error occurred.')
+            dialog.connect('response', destroyDialog)
+            dialog.show()
+        elif not cancelled:
+            self.finished(self.result)
+        return False
+
+
 class ColourDialog(gtk.Dialog):
     def __init__(self):
         gtk.Dialog.__init__(self, 'Colours',
@@ -1163,6 +1557,17 @@ class NewPuzzleDialog(gtk.Dialog):
         self.branchBox.add(self.branchSpin)
         self.branchBox.show()
 
+        seedLabel = gtk.Label('Seed')
+        seedLabel.show()
+        self.seedEntry = gtk.Entry()
+        self.seedEntry.show()
+        tooltips.set_tip(self.seedEntry, tipNewSeed)
+
+        self.seedBox = gtk.HBox(spacing = 5)
+        self.seedBox.add(seedLabel)
+        self.seedBox.add(self.seedEntry)
+        self.seedBox.show()
+
         frame = gtk.Frame()
         frame.show()
         frame.set_border_width(5)
@@ -1173,6 +1578,7 @@ class NewPuzzleDialog(gtk.Dialog):
         frameVBox.add(self.symmetricalCheck)
         frameVBox.add(self.scanCheck)
         frameVBox.add(self.branchBox)
+        frameVBox.add(self.seedBox)
         frameVBox.set_border_width(5)
         frame.add(frameVBox)
         
@@ -1186,10 +1592,12 @@ class NewPuzzleDialog(gtk.Dialog):
             self.symmetricalCheck.show()
             self.scanCheck.show()
             self.branchBox.show()
+            self.seedBox.show()
         else:
             self.symmetricalCheck.hide()
             self.scanCheck.hide()
             self.branchBox.hide()
+            self.seedBox.hide()
         self.resize(1, 1)
 
     def response(self, widget, data):
@@ -1204,6 +1612,10 @@ class NewPuzzleDialog(gtk.Dialog):
                 maxBranch = int(self.branchSpin.get_value())
                 symmetrical = self.symmetricalCheck.get_active()
                 scanOnly = self.scanCheck.get_active()
+                try:
+                    seed = int(self.seedEntry.get_text().strip())
+                except ValueError:
+                    seed = None
                 
                 self.hide()
                 
@@ -1213,7 +1625,8 @@ class NewPuzzleDialog(gtk.Dialog):
                 progress.update()
 
                 board = randomPuzzle(size, maxBranch, symmetrical, scanOnly,
-                                     progress.pulse, progress.setFraction, progress.cancelled)
+                                     progress.pulse, progress.setFraction, progress.cancelled,
+                                     seed = seed)
 
                 cancelled = progress.isCancelled
                 progress.hide()
@@ -1344,6 +1757,9 @@ if __name__ == '__main__':
     
     args = sys.argv[1:]
 
+    # Solving runs in worker threads (see BackgroundTask).
+    gobject.threads_init()
+
     gtk.window_set_default_icon_from_file(os.path.join(programDir, 'images/icon.png'))
     
     if args: